@@ -0,0 +1,154 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+
+class GranuleDownloader:
+    """
+    Download many files (e.g., ITS_LIVE velocity granules) into a local store.
+    Replaces itslive_ui.download_velocity_pairs / download_file.
+
+    - Downloads run in a thread pool of max_workers.
+    - Files already in the store are skipped before any data is fetched.
+    - Partial files (*.part) are resumed with HTTP range requests.
+    - Each file is checked against the remote size (Content-Length); a
+      partial file is restarted if the remote ETag has changed (or if the
+      server gives no ETag at all).
+    - Completed files are recorded in dest_dir/index.json as
+      {file name: {'url': ..., 'size': ..., 'etag': ...}}.
+    """
+
+    def __init__(self, dest_dir='data', max_workers=8, chunk_size=1024 ** 2,
+                 retries=3, timeout=60):
+
+        self.dest_dir = dest_dir
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.index_path = os.path.join(dest_dir, 'index.json')
+        self._lock = threading.Lock()
+        os.makedirs(dest_dir, exist_ok=True)
+        self.index = self.read_index()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers,
+                                                pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def read_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                return json.load(f)
+        return {}
+
+    def _update_index(self, file_name, entry):
+        with self._lock:
+            self.index[file_name] = entry
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(tmp_path, self.index_path)
+
+    def local_files(self):
+        """
+        Return the paths of all of the files recorded in the index.
+        """
+        return [os.path.join(self.dest_dir, file_name)
+                for file_name in self.index]
+
+    def download(self, urls):
+        """
+        Download a list of urls and return their local paths in the same
+        order. A failed download is reported and gives None.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(self._download_or_report, urls))
+
+    def _download_or_report(self, url):
+        try:
+            return self.download_file(url)
+        except (requests.RequestException, IOError) as e:
+            print('Download failed: ' + url + ' (' + str(e) + ')')
+            return None
+
+    def download_file(self, url):
+        file_name = url.split('/')[-1]
+        local_path = os.path.join(self.dest_dir, file_name)
+        entry = self.index.get(file_name)
+        if (entry is not None and entry['url'] == url
+                and os.path.exists(local_path)
+                and os.path.getsize(local_path) == entry['size']):
+            return local_path
+
+        resp = self.session.head(url, allow_redirects=True,
+                                 timeout=self.timeout)
+        resp.raise_for_status()
+        size = resp.headers.get('Content-Length')
+        size = int(size) if size is not None else None
+        etag = resp.headers.get('ETag')
+
+        if (os.path.exists(local_path) and size is not None
+                and os.path.getsize(local_path) == size):
+            # downloaded before the index existed
+            self._update_index(file_name, {'url': url, 'size': size,
+                                           'etag': etag})
+            return local_path
+
+        part_path = local_path + '.part'
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(url, part_path, etag)
+                break
+            except requests.RequestException:
+                if attempt == self.retries:
+                    raise
+
+        part_size = os.path.getsize(part_path)
+        if size is not None and part_size != size:
+            os.remove(part_path)
+            raise IOError('size mismatch: expected {} bytes, got {}'.format(
+                size, part_size))
+        os.replace(part_path, local_path)
+        self._update_index(file_name, {'url': url, 'size': part_size,
+                                       'etag': etag})
+        return local_path
+
+    def _fetch(self, url, part_path, etag):
+        """
+        Fetch url into part_path, resuming from the bytes already there.
+        The ETag of a partial file is kept in part_path + '.etag'.
+        """
+        etag_path = part_path + '.etag'
+        offset = 0
+        if os.path.exists(part_path):
+            part_etag = None
+            if os.path.exists(etag_path):
+                with open(etag_path) as f:
+                    part_etag = f.read() or None
+            if etag is not None and part_etag == etag:
+                offset = os.path.getsize(part_path)
+        if etag is not None:
+            with open(etag_path, 'w') as f:
+                f.write(etag)
+
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = etag
+        with self.session.get(url, headers=headers, stream=True,
+                              timeout=self.timeout) as r:
+            if r.status_code == 416:
+                # the partial file is already complete
+                pass
+            else:
+                r.raise_for_status()
+                # 206: the server resumes; 200: it sends the whole file again
+                mode = 'ab' if r.status_code == 206 else 'wb'
+                with open(part_path, mode) as f:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+        if os.path.exists(etag_path):
+            os.remove(etag_path)
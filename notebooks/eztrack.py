@@ -1,52 +1,91 @@
 import os
 os.environ['GDAL_SKIP'] = 'DODS'
+os.environ.setdefault('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')   # do not list the S3 "directory" of a remote scene
 import logging
-import isce
+try:
+    import isce
+    from carst.libft import ampcor_task, writeout_ampcor_task
+except ImportError:
+    # ISCE is only needed by the ampcor kernel ('CARST');
+    # the NumPy NCC kernel runs without it.
+    isce = None
 root_logger = logging.getLogger()
 root_logger.setLevel('WARNING')
 from carst import SingleRaster, ConfParams
-from carst.libft import ampcor_task, writeout_ampcor_task
 from carst.libxyz import AmpcoroffFile
-
+from ncc import ncc_task, writeout_ncc_task
+from prepcache import PreprocessCache, overlap_params
+from velofield import ampcor_field, clip_field, offsets_to_velocity, write_cog
+from postproc import postprocess as postprocess_velocity
+
+import io
+import sys
+import hashlib
+import json
+import copy
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 import pandas as pd
+from shapely.geometry import shape
 import ipyleaflet as ilfl
 import ipywidgets as iwg
 from geostacks import SpatialIndexLS8, SpatialIndexITSLIVE
-import xarray as xr
-import rasterio
-import fsspec
+from velostacks import open_granule, VelocityStack, VelocityStore
 from datetime import datetime
 
-import subprocess
+from osgeo import gdal
 
 
-# CARST monkey patch (to temporarily resolve .tiff vs .tif issue)
+# CARST monkey patch (in-process warping instead of calling gdalwarp; also resolves the .tiff vs .tif issue)
 
 def Unify(self, params):
-    """ Use gdalwarp to clip, reproject, and resample a DEM using a given set of params (which can 'unify' all DEMs). """
-
-    print('Calling Gdalwarp...')
-    fpath_warped = self.fpath[:-5] + '_warped' + self.fpath[-5:]
-    if 'output_dir' in params:
-        newpath = '/'.join([params['output_dir'], fpath_warped.split('/')[-1]])
+    """
+    Use gdal.Warp to clip, reproject, and resample a raster using a given set of params (which can 'unify' all rasters).
+    Only the source blocks that overlap the target extent are read, so a remote COG is read by range requests.
+
+    params: 't_srs', 'tr' ('xres yres'), 'te' ('xmin ymin xmax ymax'), and optionally
+            'output_dir'
+            'of':      output format. 'VRT' writes a warped VRT (the warping is done when the data are read);
+                       'MEM' keeps the warped raster in memory (a /vsimem/ path).
+            'ot':      output data type (e.g., 'Float32').
+            'threads': number of warp threads (default: 'ALL_CPUS').
+            'wm':      warp memory limit in MB.
+    """
+    src_path = self.fpath
+    if src_path.startswith('http://') or src_path.startswith('https://'):
+        src_path = '/vsicurl/' + src_path
+    root, ext = os.path.splitext(os.path.basename(self.fpath))
+    output_format = params.get('of')
+    if output_format == 'VRT':
+        ext = '.vrt'
+    if output_format == 'MEM':
+        newpath = '/vsimem/' + root + '_warped' + ext
+        output_format = 'GTiff'
+    elif 'output_dir' in params:
+        newpath = os.path.join(params['output_dir'], root + '_warped' + ext)
     else:
         # for pixel tracking (temporarily)
         newfolder = 'test_folder'
         if not os.path.exists(newfolder):
             os.makedirs(newfolder)
-        newpath = '/'.join([newfolder, fpath_warped.split('/')[-1]])
-        newpath = newpath.replace(newpath.split('.')[-1], 'img')
-    gdalwarp_cmd = 'gdalwarp -t_srs ' + params['t_srs'] + ' -tr ' + params['tr'] + ' -te ' + params['te']
-    if 'of' in params:
-        gdalwarp_cmd += ' -of ' + params['of']
-    if 'ot' in params:
-        gdalwarp_cmd += ' -ot ' + params['ot']
-    gdalwarp_cmd += ' -overwrite ' + self.fpath + ' ' + newpath
-    print(gdalwarp_cmd)
-    retcode = subprocess.call(gdalwarp_cmd, shell=True)
-    if retcode != 0:
-        print('Gdalwarp failed. Please check if all the input parameters are properly set.')
-        sys.exit(retcode)
+        newpath = os.path.join(newfolder, root + '_warped.img')
+    warp_options = gdal.WarpOptions(format=output_format,
+                                    dstSRS=params['t_srs'].strip('"\''),
+                                    xRes=float(params['tr'].split()[0]),
+                                    yRes=float(params['tr'].split()[1]),
+                                    outputBounds=[float(i) for i in params['te'].split()],
+                                    outputType=gdal.GetDataTypeByName(params['ot']) if 'ot' in params else gdal.GDT_Unknown,
+                                    multithread=True,
+                                    warpOptions=['NUM_THREADS={}'.format(params.get('threads', 'ALL_CPUS'))],
+                                    warpMemoryLimit=params.get('wm'))
+    print('Warping ' + self.fpath + ' to ' + newpath)
+    ds = gdal.Warp(newpath, src_path, options=warp_options)
+    if ds is None:
+        print('Warping failed. Please check if all the input parameters are properly set.')
+        raise RuntimeError('gdal.Warp failed: ' + gdal.GetLastErrorMsg())
+    ds.FlushCache()
+    ds = None    # close the file
     self.fpath = newpath
 
 SingleRaster.Unify = Unify
@@ -77,32 +116,55 @@ class eztrack_ui():
         self.spatial_index = spatial_index
         self.output = iwg.Output()   # print message output
         self.results = None
+        self.velo = None         # velocity field (xarray Dataset) of the last CARST run
+        self.stack = None        # VelocityStack of the selected ITS_LIVE granules
         self.ft_params = None     # feature tracking parameters
         self.sld1 = None         # param slider #1
         self.sld2 = None         # param slider #2
         self.sld3 = None         # param slider #3
+        self.itslive_buffer = 50000.   # ITS_LIVE data are cut to +/- this size (m) around query_pt
+        self.aoiselection = None
+        self.aoi_buffer = 10000.       # 'Marker buffer' AOI: +/- this size (m) around query_pt
+        self.draw_control = None
+        self.drag_delay = 0.3          # the path/rows are queried once the marker has not moved for this long (s)
+        self.drag_timer = None
+        self.drawn_aoi = None          # the last polygon drawn on the map (shapely, lon/lat)
+        self.max_jobs = 4              # searches / tracking jobs that run at the same time
+        self.executor = None           # runs the jobs in the background (see submit_job)
+        self.jobs = []                 # jobs submitted since the last time all of them finished
+        self.cancel_event = threading.Event()
+        self.n_jobs = 0                # number of jobs submitted so far
+        self.cache = None              # PreprocessCache of the tracking jobs (keyed on the target grid)
+        self.progress = None           # progress bar of the jobs
+        self.cancel_btn = None
         
     def init_panelleft(self):
         self.ui_title = iwg.HTML("<h2>Drag the marker to your region of interest</h2>")
-        self.idxs = self.spatial_index.query_pathrow(self.query_pt)
-        self.prlist = [('{:03d}/{:03d}'.format(self.spatial_index.footprint.loc[i, 'path'], self.spatial_index.footprint.loc[i, 'row']) ,i) for i in self.idxs]
+        self.idxs = self.spatial_index.query_pathrow_cached(self.query_pt)
+        self.prlist = self.spatial_index.pathrow_options(self.idxs)
         self.menuleft = iwg.Select(options=self.prlist, description='Path/Row:', rows=15)
-        self.kernelselection = iwg.RadioButtons(options=['ITS_LIVE (online ready)', 'CARST'], value='ITS_LIVE (online ready)', description='Data / Kernel:')
+        self.kernelselection = iwg.RadioButtons(options=['ITS_LIVE (online ready)', 'CARST', 'CARST (NumPy NCC)'], value='ITS_LIVE (online ready)', description='Data / Kernel:')
         self.datesearch_btn = iwg.Button(description='Search for dates')
         
     def init_panelright(self):
         self.menuright = iwg.SelectMultiple(options=self.scenelist, description='Data entries:', rows=20)
         self.bandselection = iwg.RadioButtons(options=['B4', 'B8'], value='B8', description='Band (LS8):')
+        self.aoiselection = iwg.RadioButtons(options=['Full scene', 'Marker buffer', 'Drawn polygon'], value='Full scene', description='AOI (LS8):')
         self.runft_btn = iwg.Button(description='Get data / Start feature tracking')
+        self.progress = iwg.IntProgress(value=0, min=0, max=1, description='Idle')
+        self.cancel_btn = iwg.Button(description='Cancel jobs')
 
     def init_map(self):
         self.mainmap = ilfl.Map(basemap=ilfl.basemaps.Gaode.Satellite, center=[self.query_pt[-1], self.query_pt[0]], zoom=self.zoom)
         self.marker = ilfl.Marker(location=[self.query_pt[-1], self.query_pt[0]], draggable=True)
         self.mainmap.add_layer(self.marker)
         self.pr_selection = self.idxs[0]
-        self.scene_list = pd.DataFrame(columns=('prefix', 'time', 'tier'))
+        self.scene_list = SpatialIndexLS8.build_scene_list([])
         self.map_polygon = ilfl.WKTLayer(wkt_string=self.spatial_index.footprint.loc[self.pr_selection].geometry.wkt)
         self.mainmap.add_layer(self.map_polygon)
+        self.draw_control = ilfl.DrawControl(polyline={}, circlemarker={})
+        self.draw_control.rectangle = {'shapeOptions': {'color': '#ff7800'}}
+        self.mainmap.add_control(self.draw_control)
         
     def gen_ui(self, spatial_index=None, ft_params=None):
         if self.spatial_index is None:
@@ -116,15 +178,19 @@ class eztrack_ui():
         self.init_panelleft()
         self.init_panelright()
         self.init_map()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_jobs)
+        self.cache = PreprocessCache()
         
         self.marker.observe(self._on_location_changed, 'location')
         self.menuleft.observe(self._on_menuleft_selection_changed, names='value')
         self.datesearch_btn.on_click(self._on_searchbutton_clicked)
         self.runft_btn.on_click(self._on_ftbutton_clicked)
+        self.cancel_btn.on_click(self._on_cancelbutton_clicked)
+        self.draw_control.on_draw(self._on_aoi_drawn)
         
         leftside = iwg.VBox([self.ui_title, self.menuleft, self.kernelselection, self.datesearch_btn])
         leftside.layout.align_items = 'center'
-        rightside = iwg.VBox([self.menuright, self.bandselection, self.runft_btn])
+        rightside = iwg.VBox([self.menuright, self.bandselection, self.aoiselection, self.runft_btn, self.progress, self.cancel_btn])
         rightside.layout.align_items = 'center'
         return iwg.AppLayout(left_sidebar=leftside, center=self.mainmap, right_sidebar=rightside)
 
@@ -132,10 +198,19 @@ class eztrack_ui():
     
     def _on_location_changed(self, event):
         # global query_pt, idx
+        # while the marker is dragged, only the position where it settles is queried
         self.query_pt = [self.marker.location[-1], self.marker.location[0]]
-        self.idxs = self.spatial_index.query_pathrow(self.query_pt)
-        self.prlist = [('{:03d}/{:03d}'.format(self.spatial_index.footprint.loc[i, 'path'], self.spatial_index.footprint.loc[i, 'row']) ,i) for i in self.idxs]
-        self.menuleft.options = self.prlist
+        if self.drag_timer is not None:
+            self.drag_timer.cancel()
+        self.drag_timer = threading.Timer(self.drag_delay, self._update_pathrows)
+        self.drag_timer.start()
+
+    def _update_pathrows(self):
+        self.idxs = self.spatial_index.query_pathrow_cached(self.query_pt)
+        prlist = self.spatial_index.pathrow_options(self.idxs)
+        if prlist != self.prlist:
+            self.prlist = prlist
+            self.menuleft.options = self.prlist
         
     # ==== map polygon update when leftmenu selection changes
 
@@ -144,23 +219,131 @@ class eztrack_ui():
         self.pr_selection = change['new']
         self.map_polygon.wkt_string=self.spatial_index.footprint.loc[self.pr_selection].geometry.wkt
 
+    # ==== AOI for feature tracking
+
+    def _on_aoi_drawn(self, target, action, geo_json):
+        if action == 'deleted':
+            self.drawn_aoi = None
+        else:
+            self.drawn_aoi = shape(geo_json['geometry'])
+            self.aoiselection.value = 'Drawn polygon'
+
+    def get_aoi(self):
+        """
+        The AOI selected in the UI as (min_lon, min_lat, max_lon, max_lat) or a shapely geometry in lon/lat;
+        None for the full scene.
+        """
+        if self.aoiselection.value == 'Marker buffer':
+            lon, lat = self.query_pt
+            dlat = self.aoi_buffer / 111320.
+            dlon = dlat / np.cos(np.radians(lat))
+            return (lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+        elif self.aoiselection.value == 'Drawn polygon':
+            if self.drawn_aoi is None:
+                print('No polygon has been drawn on the map. Using the full scene.')
+            return self.drawn_aoi
+        return None
+
+    # ==== background jobs
+
+    def submit_job(self, description, func, on_done=None):
+        """
+        Run func(job) in self.executor and return its future at once. job is a dict with the progress of the job
+        ('done' of 'total') and its 'cancel' event; long jobs may update the former and check the latter.
+        on_done(result) is called when func returns, unless the job has been cancelled.
+        """
+        self.n_jobs += 1
+        job = {'description': description, 'done': 0, 'total': 1, 'cancel': self.cancel_event, 'number': self.n_jobs,
+               'stdout': _JobOutput.install()}
+        self.jobs.append(job)
+        self._update_progress()
+        job['future'] = self.executor.submit(self._run_job, func, job)
+        job['future'].add_done_callback(lambda future: self._on_job_done(future, job, on_done))
+        return job['future']
+
+    def _run_job(self, func, job):
+        # the Output widget context does not work in other threads; see _JobOutput
+        job['stdout'].outputs[threading.get_ident()] = self.output
+        try:
+            return func(job)
+        finally:
+            del job['stdout'].outputs[threading.get_ident()]
+
+    def _on_job_done(self, future, job, on_done):
+        try:
+            if future.cancelled() or job['cancel'].is_set():
+                self.output.append_stdout(job['description'] + ': cancelled.\n')
+            elif future.exception() is not None:
+                self.output.append_stdout(job['description'] + ': failed (' + str(future.exception()) + ')\n')
+            else:
+                self.output.append_stdout(job['description'] + ': done.\n')
+                if on_done is not None:
+                    on_done(future.result())
+        finally:
+            _JobOutput.uninstall()
+        job['done'] = job['total']
+        job['finished'] = True
+        self._update_progress()
+
+    def _update_progress(self):
+        running = [job for job in self.jobs if not job.get('finished')]
+        self.progress.max = max(sum(job['total'] for job in self.jobs), 1)
+        self.progress.value = sum(job['done'] for job in self.jobs)
+        self.progress.description = '{} job(s)'.format(len(running)) if running else 'Idle'
+        if not running:
+            self.jobs = []
+
+    @staticmethod
+    def job_folder(params, aoi):
+        """
+        The output folder of the tracking jobs on an AOI, inside params.outputcontrol['output_folder'].
+        Jobs on different AOIs (e.g., the same pair) do not overwrite each other, and the file names carry the
+        date pair (datepair_prefix). Running a batch on the same AOI again reuses the folder, so that
+        BatchFeatureTrack skips the pairs already done.
+        """
+        name = 'full_scene' if aoi is None else 'aoi_' + hashlib.sha1(str(aoi).encode()).hexdigest()[:10]
+        folder = os.path.join(params.outputcontrol['output_folder'], name)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def _on_cancelbutton_clicked(self, event):
+        # jobs that are already running finish, but their results are dropped
+        self.cancel_event.set()
+        self.cancel_event = threading.Event()
+        for job in self.jobs:
+            if job.get('future') is not None:
+                job['future'].cancel()
+
     # ==== search button click callback
 
     def _on_searchbutton_clicked(self, event):
         # global pr_scene_list
-        with self.output:
-            if self.kernelselection.value == 'CARST':
-                s3_prefix, self.scenelist = self.spatial_index.search_s3(self.pr_selection)
+        pr_selection = self.pr_selection
+        if self.kernelselection.value in ('CARST', 'CARST (NumPy NCC)'):
+            def search(job):
+                s3_prefix, scenelist = self.spatial_index.search_s3(pr_selection)
                 # print(s3_prefix)
-                self.menuright.options = [(record['time'], idx) for idx, record in self.scenelist.loc[self.scenelist['tier'] == 'T1'].iterrows()]
-            elif self.kernelselection.value == 'ITS_LIVE (online ready)':
-                # query_pt = [mker.location[-1], mker.location[0]]
-                polygon_coords = SpatialIndexITSLIVE.get_minimal_bbox(self.query_pt)
+                return scenelist
+
+            def show(scenelist):
+                self.scenelist = scenelist
+                self.menuright.options = SpatialIndexLS8.scene_options(self.scenelist, tier='T1')
+            self.submit_job('Search for LS8 scenes', search, on_done=show)
+        elif self.kernelselection.value == 'ITS_LIVE (online ready)':
+            # query_pt = [mker.location[-1], mker.location[0]]
+            query_pt = list(self.query_pt)
+            pr_dict_key = self.spatial_index.pathrow_labels[pr_selection]
+
+            def search(job):
+                polygon_coords = SpatialIndexITSLIVE.get_minimal_bbox(query_pt)
                 params = {'polygon': polygon_coords, 'percent_valid_pixels': 1, 'start': '2015-01-01', 'end': '2020-01-01'}
-                urls = SpatialIndexITSLIVE.get_granule_urls(params)
-                self.scenelist = SpatialIndexITSLIVE.parse_urls(urls)
-                pr_dict_key = '{:03d}/{:03d}'.format(self.spatial_index.footprint.loc[self.pr_selection, 'path'], self.spatial_index.footprint.loc[self.pr_selection, 'row'])
+                urls = SpatialIndexITSLIVE.get_granule_urls(params, cache=self.spatial_index.cache)
+                return SpatialIndexITSLIVE.parse_urls(urls)
+
+            def show(scenelist):
+                self.scenelist = scenelist
                 self.menuright.options = [(i['entrystr'], i['url']) for i in self.scenelist[pr_dict_key]]
+            self.submit_job('Search for ITS_LIVE granules', search, on_done=show)
                 
     # ==== feature tracking button click callback
 
@@ -172,21 +355,73 @@ class eztrack_ui():
     def _on_ftbutton_clicked(self, ft):
         # global file1_url, file1_date, file2_url, file2_date
         with self.output:
-            if self.kernelselection.value == 'CARST':
+            if self.kernelselection.value in ('CARST', 'CARST (NumPy NCC)'):
                 selected_list = self.scenelist.loc[list(self.menuright.value)]
+                kernel = 'ncc' if self.kernelselection.value == 'CARST (NumPy NCC)' else 'ampcor'
+                aoi = self.get_aoi()
+                # every job gets its own copy of the parameters (carst_featuretrack modifies them)
+                params = copy.deepcopy(self.ft_params)
+                params.outputcontrol['output_folder'] = self.job_folder(params, aoi)
+                params.outputcontrol['datepair_prefix'] = True
+                print('Output folder: ' + params.outputcontrol['output_folder'])
+                if len(selected_list) > 2:
+                    # every selected scene is paired with the next one
+                    batch = BatchFeatureTrack(params=params, band=self.bandselection.value, kernel=kernel,
+                                              output_folder=params.outputcontrol['output_folder'], cache=self.cache, aoi=aoi)
+                    pairs = generate_pairs(selected_list, n_nearest=1)
+
+                    def track(job):
+                        job['total'] = len(pairs)
+                        self._update_progress()
+
+                        def progress(done, total):
+                            job['done'] = done
+                            self._update_progress()
+                        return batch.run(selected_list, pairs, progress=progress, cancel=job['cancel'])
+
+                    def show(manifest):
+                        self.results = manifest
+                    self.submit_job('Feature tracking of {} pairs'.format(len(pairs)), track, on_done=show)
+                    return
                 selected_list_prefix = selected_list['prefix'].tolist()
                 selected_list_time = selected_list['time'].tolist()
-                file1_url = 'https://landsat-pds.s3.amazonaws.com/' + selected_list_prefix[0] + os.path.basename(selected_list_prefix[0][:-1]) + '_' + self.bandselection.value + '.TIF'
-                file2_url = 'https://landsat-pds.s3.amazonaws.com/' + selected_list_prefix[1] + os.path.basename(selected_list_prefix[1][:-1]) + '_' + self.bandselection.value + '.TIF'
+                file1_url = SpatialIndexLS8.scene_url(selected_list_prefix[0], self.bandselection.value)
+                file2_url = SpatialIndexLS8.scene_url(selected_list_prefix[1], self.bandselection.value)
                 file1_date = selected_list_time[0].strftime('%Y-%m-%d')
                 file2_date = selected_list_time[1].strftime('%Y-%m-%d')
                 print(file1_url, file1_date, file2_url, file2_date)
-                carst_featuretrack(file1_url, file1_date, file2_url, file2_date, params=self.ft_params)
-                self.results = rasterio.open(selected_list_time[0].strftime('%Y%m%d') + '-' + selected_list_time[1].strftime('%Y%m%d') + '_velo-raw_mag.tif')
+
+                def track(job):
+                    # the warped scenes go into the cache, whose entries are keyed on the grid (and so on the AOI)
+                    return carst_featuretrack(file1_url, file1_date, file2_url, file2_date, params=params, kernel=kernel,
+                                              cache=self.cache, aoi=aoi, in_memory=True)
+
+                def show(result):
+                    if result is not None:
+                        self.velo, self.results = result
+                self.submit_job('Feature tracking of ' + file1_date + ' - ' + file2_date, track, on_done=show)
             elif self.kernelselection.value == 'ITS_LIVE (online ready)':
-                print(self.menuright.value)
-                with fsspec.open(self.menuright.value[0]) as fobj:
-                    self.results = xr.open_dataset(fobj)
+                urls = list(self.menuright.value)
+                query_pt = list(self.query_pt)
+                print(urls)
+                if len(urls) > 1:
+                    # all selected granules as one (mid_date, y, x) cube
+                    def load(job):
+                        return VelocityStack().build(urls, point=query_pt, buffer=self.itslive_buffer)
+
+                    def show(stack):
+                        if self.stack is not None:
+                            self.stack.close()
+                        self.stack = stack
+                        self.results = self.stack.cube
+                    self.submit_job('Stacking {} ITS_LIVE granules'.format(len(urls)), load, on_done=show)
+                else:
+                    def load(job):
+                        return open_granule(urls[0], point=query_pt, buffer=self.itslive_buffer, load=True)
+
+                    def show(ds):
+                        self.results = ds
+                    self.submit_job('Loading the ITS_LIVE granule', load, on_done=show)
                     
     # ==== Initialize feature tracking parameters
     
@@ -238,7 +473,53 @@ class FTParams:
                               'if_generate_xyztext': False,
                               'label_ampcor': 'ampoff',
                               'label_geotiff': 'velo-raw'}
-        
+        self.velocorrection = {'bedrock': None,     # a shapefile of stable ground
+                               'refvelo_outlier_sigma': 3.0}
+        self.noiseremoval  = {'snr': 5,
+                              'gaussian_lp_mask_sigma': 5,
+                              'min_clump_size': 101,
+                              'outlier_sigma_threshold': 3}
+
+    def ReadParam(self, fpath):
+
+        """
+        Read an ini file (e.g., param.ini) over the defaults. carst's ConfParams keeps every value as a string;
+        here a value takes the type of its default (bool, int, float or str; numbers for new keys), and an empty
+        value becomes None. A relative bedrock path is also looked up next to the ini file.
+        """
+
+        conf = ConfParams(fpath)
+        conf.ReadParam()
+        for section in vars(conf):
+            if section == 'fpath':
+                continue
+            params = getattr(self, section, {})
+            for key, value in getattr(conf, section).items():
+                params[key] = self._typed(value, params.get(key))
+            setattr(self, section, params)
+        bedrock = self.velocorrection.get('bedrock')
+        if bedrock and not os.path.exists(bedrock):
+            relative_path = os.path.join(os.path.dirname(fpath), bedrock)
+            if os.path.exists(relative_path):
+                self.velocorrection['bedrock'] = relative_path
+        return self
+
+    @staticmethod
+    def _typed(value, default):
+        value = value.strip()
+        if value == '':
+            return None
+        if isinstance(default, bool):
+            return value.lower() in ['true', 't', 'yes', 'y', '1']
+        if isinstance(default, str):
+            return value
+        for number_type in (int, float):
+            try:
+                return number_type(value)
+            except ValueError:
+                pass
+        return value
+
     def VerifyParams(self):
 
         """
@@ -272,52 +553,377 @@ class FTParams:
                 else:
                     self.rawoutput['label_geotiff'] = os.path.join(self.outputcontrol['output_folder'], self.rawoutput['label_geotiff'])
 
+class _JobOutput(io.TextIOBase):
+    """
+    sys.stdout while eztrack_ui runs jobs: the text printed by a job thread goes to the Output widget of its UI
+    (with append_stdout, which works from any thread), and the rest to the original stream.
+    install() is called for every job and uninstall() when it is done; the original stream is put back when
+    the last job of all UIs is done. The other attributes of the stream (encoding, fileno, ...) are forwarded.
+    """
+
+    _lock = threading.Lock()
+    _installed = None
+    _n_jobs = 0
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.outputs = {}    # thread id -> Output widget
+
+    @classmethod
+    def install(cls):
+        with cls._lock:
+            if cls._n_jobs == 0:
+                cls._installed = cls(sys.stdout)
+                sys.stdout = cls._installed
+            cls._n_jobs += 1
+            return cls._installed
+
+    @classmethod
+    def uninstall(cls):
+        with cls._lock:
+            cls._n_jobs -= 1
+            if cls._n_jobs == 0:
+                if sys.stdout is cls._installed:    # unless it has been replaced since
+                    sys.stdout = cls._installed.stream
+                cls._installed = None
+
+    @property
+    def encoding(self):
+        return self.stream.encoding
+
+    @property
+    def errors(self):
+        return self.stream.errors
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def isatty(self):
+        return self.stream.isatty()
+
+    def writable(self):
+        return True
+
+    def __getattr__(self, name):
+        if name == 'stream':
+            raise AttributeError(name)
+        return getattr(self.stream, name)
+
+    def write(self, text):
+        output = self.outputs.get(threading.get_ident())
+        if output is None:
+            return self.stream.write(text)
+        output.append_stdout(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
 # CARST feature tracking workflow                    
 
-def carst_featuretrack(file1_url, file1_date, file2_url, file2_date, params=None, inipath='param.ini'):
+
+def carst_featuretrack(file1_url, file1_date, file2_url, file2_date, params=None, inipath='param.ini', kernel='ampcor', unify=True,
+                       cache=None, grid=None, aoi=None, resolution=None, in_memory=False, postprocess=False, store=None):
+    """
+    kernel:     'ampcor' (ISCE's ampcor) or 'ncc' (the in-process NumPy NCC kernel in ncc.py, no ISCE needed).
+    unify:      warp both images onto their common grid. Set to False if both images are already on the same grid.
+    cache:      a PreprocessCache. Both images are then warped (and filtered) through the cache,
+                so that a scene used by many pairs is preprocessed only once.
+    grid:       the target grid (see prepcache.overlap_params). Default: the overlap of the two images (and of aoi),
+                on the pixel grid of image 1. Only this window is fetched from remote images.
+    aoi:        (min_lon, min_lat, max_lon, max_lat) or a shapely geometry in lon/lat. The default grid covers its
+                bounding box; for a geometry, the chips outside of the geometry itself are dropped as well.
+    resolution: pixel size of the default grid; a coarser one reads the overviews of the images.
+    in_memory:  keep the offsets in memory (no .p file) and write the velocity magnitude, vx, vy and SNR as the bands
+                of one Cloud-Optimized GeoTIFF (ini.rawoutput['label_geotiff'] + '.tif', see velofield.write_cog).
+                Returns the velocity field as an xarray Dataset (see velofield.offsets_to_velocity) and the COG
+                opened with rasterio.
+    postprocess: in the in_memory mode, apply the bedrock correction and the noise removal of
+                 ini.velocorrection and ini.noiseremoval (see postproc.postprocess) before writing.
+    store:      a velostacks.VelocityStore. In the in_memory mode, the velocity field is also appended to it.
+    """
     if params is not None:
         ini = params
     else:
-        ini = ConfParams(inipath)
-        ini.ReadParam()
+        ini = FTParams().ReadParam(inipath)
     ini.imagepair['image1'] = file1_url
     ini.imagepair['image2'] = file2_url
     ini.imagepair['image1_date'] = file1_date
     ini.imagepair['image2_date'] = file2_date
     ini.VerifyParams()
-    a = SingleRaster(file1_url, date=file1_date)
-    b = SingleRaster(file2_url, date=file2_date)
-    # ========== Unifying LS8 image extent ========== 
-    te_a = a.GetExtent()
-    tr_a = (a.GetXRes(), -a.GetYRes())
-    t_srs_a = a.GetProj4()
-    params_unify = {'output_dir': '.', 't_srs': '"' + t_srs_a + '"', 'tr': '{} {}'.format(*tr_a), 'te': '{} {} {} {}'.format(te_a[0], te_a[3], te_a[2], te_a[1])}
-    b.Unify(params_unify)
-    # ===============================================
-    if ini.pxsettings['gaussian_hp']:
-        a.GaussianHighPass(sigma=ini.pxsettings['gaussian_hp_sigma'])
-        b.GaussianHighPass(sigma=ini.pxsettings['gaussian_hp_sigma'])
-    a.AmpcorPrep()
-    b.AmpcorPrep()
-    task = ampcor_task([a, b], ini)
-    writeout_ampcor_task(task, ini)
+    if kernel != 'ncc' and isce is None:
+        print('Error: ISCE is not installed. Please use the NumPy NCC kernel (kernel=\'ncc\').')
+        return
+    hp_sigma = None
+    if kernel != 'ncc' and ini.pxsettings['gaussian_hp']:
+        # the NCC kernel applies the high-pass filter in memory (ncc_task)
+        hp_sigma = ini.pxsettings['gaussian_hp_sigma']
+    if unify and grid is None:
+        grid = overlap_params([file1_url, file2_url], aoi=aoi, resolution=resolution)
+    if cache is not None:
+        a, b = cache.prepare_pair([file1_url, file2_url], [file1_date, file2_date], grid=grid, gaussian_hp_sigma=hp_sigma,
+                                  ampcor_prep=kernel != 'ncc')
+    else:
+        a = SingleRaster(file1_url, date=file1_date)
+        b = SingleRaster(file2_url, date=file2_date)
+        # ========== Unifying LS8 image extent ========== 
+        if unify:
+            a.Unify(dict(grid, output_dir='.'))
+            b.Unify(dict(grid, output_dir='.'))
+        # ===============================================
+        if hp_sigma:
+            a.GaussianHighPass(sigma=hp_sigma)
+            b.GaussianHighPass(sigma=hp_sigma)
+        if kernel != 'ncc':
+            a.AmpcorPrep()
+            b.AmpcorPrep()
+    if kernel == 'ncc':
+        # high-pass filter and correlation run tile by tile on ini.pxsettings['threads'] processes
+        field = ncc_task([a, b], ini)
+    else:
+        task = ampcor_task([a, b], ini)
+        field = ampcor_field(task)
+    clipped = hasattr(aoi, 'geom_type')
+    if clipped:
+        # the grid covers the bounding box of the AOI polygon
+        field = clip_field(field, a.GetGeoTransform(), a.GetProjection(), aoi)
+    if in_memory:
+        velo = offsets_to_velocity(field, a.GetGeoTransform(), (b.date - a.date).days, ini.pxsettings['skip_across'],
+                                   projection=a.GetProjection())
+        if postprocess:
+            velo = postprocess_velocity(velo, ini)
+        if store is not None:
+            store.append(velo, a.date, b.date)
+        return velo, write_cog(velo, ini.rawoutput['label_geotiff'] + '.tif')
+    if postprocess or store is not None:
+        print('Post-processing and velocity stores need in_memory=True. Skip them.')
+    if kernel == 'ncc' or clipped:
+        writeout_ncc_task(field, ini)    # the same .p file as writeout_ampcor_task
+    else:
+        writeout_ampcor_task(task, ini)
     ampoff = AmpcoroffFile(ini.rawoutput['label_ampcor'] + '.p')
     ampoff.Load()
     ampoff.SetIni(ini)
     ampoff.FillwithNAN()   # fill holes with nan
-    ampoff.Ampcoroff2Velo()
+    # the offsets are on the grid of the warped image 1, not on the grid of ini.imagepair['image1']
+    ampoff.Ampcoroff2Velo(ref_raster=a, datedelta=b.date - a.date)
     ampoff.Velo2XYV(generate_xyztext=ini.rawoutput['if_generate_xyztext'])
-    ampoff.XYV2Raster()
-
-
-
-
-
-
-
-
-
-
-
+    ampoff.XYV2Raster(ref_raster=a)
+
+
+# Batch feature tracking
+
+def generate_pairs(scene_list, max_baseline=None, min_baseline=1, months=None, n_nearest=None):
+    """
+    Generate image pairs from a scene list (the output of SpatialIndexLS8.search_s3).
+
+    max_baseline: maximum time between the two images (days).
+    min_baseline: minimum time between the two images (days).
+    months:       if given, both images need to be acquired in these months (e.g., [6, 7, 8, 9]
+                  for a summer season) of the same year.
+    n_nearest:    if given, each scene is paired with (at most) its n_nearest next scenes.
+    output:
+        a DataFrame with one pair per row: idx1 and idx2 (scene_list index), time1, time2, and baseline (days).
+    """
+    scenes = scene_list.sort_values('time', kind='stable')
+    if months is not None:
+        scenes = scenes[scenes['time'].dt.month.isin(months)]
+    t = scenes['time'].values
+    i, j = np.triu_indices(len(scenes), k=1)   # sorted by i, then by j
+    baseline = (t[j] - t[i]) / np.timedelta64(1, 'D')
+    keep = baseline >= min_baseline
+    if max_baseline is not None:
+        keep &= baseline <= max_baseline
+    if months is not None:
+        years = scenes['time'].dt.year.values
+        keep &= years[i] == years[j]
+    i, j, baseline = i[keep], j[keep], baseline[keep]
+    if n_nearest is not None:
+        rank = np.arange(i.size) - np.searchsorted(i, i)
+        keep = rank < n_nearest
+        i, j, baseline = i[keep], j[keep], baseline[keep]
+    return pd.DataFrame({'idx1': scenes.index.values[i],
+                         'idx2': scenes.index.values[j],
+                         'time1': t[i],
+                         'time2': t[j],
+                         'baseline': baseline})
+
+
+class BatchFeatureTrack:
+    """
+    Run carst_featuretrack on many image pairs (e.g., from generate_pairs) with a process pool.
+
+    - Every scene is warped (and filtered) onto a common grid (the grid of the earliest scene, clipped to aoi)
+      only once, through a PreprocessCache shared by all of the pairs.
+    - Pairs whose velocity raster is already in output_folder are skipped.
+    - The status of every pair is written to output_folder/manifest.json.
+    - With store='zarr' (or 'netcdf'), every velocity field is also appended to a time series store of its
+      path/row in output_folder (velostacks.VelocityStore, e.g., velocity_009011.zarr), on the common grid.
+      The pairs are then tracked in the in_memory mode of carst_featuretrack.
+    """
+
+    def __init__(self, params=None, inipath='param.ini', band='B8', kernel='ncc', output_folder='.',
+                 cache=None, aoi=None, max_workers=4, threads_per_pair=1, store=None):
+
+        self.params = params
+        self.inipath = inipath
+        self.band = band
+        self.kernel = kernel
+        self.output_folder = output_folder
+        self.cache = PreprocessCache() if cache is None else cache
+        self.aoi = aoi
+        self.max_workers = max_workers
+        self.threads_per_pair = threads_per_pair
+        self.store = store
+        self.manifest_path = os.path.join(output_folder, 'manifest.json')
+        self.manifest = None
+
+    def new_params(self):
+        """
+        A fresh copy of the parameters for one pair (VerifyParams modifies them in place).
+        """
+        if self.params is not None:
+            ini = copy.deepcopy(self.params)
+        else:
+            ini = FTParams().ReadParam(self.inipath)
+        ini.outputcontrol['output_folder'] = self.output_folder
+        ini.outputcontrol['datepair_prefix'] = True
+        ini.pxsettings['threads'] = self.threads_per_pair
+        return ini
 
+    def pair_output(self, time1, time2, ini=None):
+        """
+        Path of the velocity magnitude raster of a pair (the COG of all bands with a store).
+        """
+        if ini is None:
+            ini = self.new_params()
+        label_datepair = pd.Timestamp(time1).strftime('%Y%m%d') + '-' + pd.Timestamp(time2).strftime('%Y%m%d') + '_'
+        suffix = '.tif' if self.store else '_mag.tif'
+        return os.path.join(self.output_folder, label_datepair + ini.rawoutput['label_geotiff'] + suffix)
 
+    def pair_store(self, prefix, grid):
+        """
+        The VelocityStore of the path/row of a scene, on the target grid.
+        """
+        if not self.store:
+            return None
+        path, row = prefix.split('/')[2:4]
+        te = [float(i) for i in grid['te'].split()]
+        return VelocityStore(VelocityStore.pathrow_path(self.output_folder, path, row, netcdf=self.store == 'netcdf'),
+                             bounds=te)
+
+    def run(self, scene_list, pairs, progress=None, cancel=None):
+        """
+        scene_list: the output of SpatialIndexLS8.search_s3.
+        pairs:      the output of generate_pairs.
+        progress:   called as progress(number of finished pairs, number of pairs to track) during the run.
+        cancel:     a threading.Event. Once it is set, the pairs that have not started are cancelled.
+        output:
+            the manifest as a DataFrame (one row per pair).
+        """
+        os.makedirs(self.output_folder, exist_ok=True)
+        ini = self.new_params()
+        jobs = []
+        for pair in pairs.itertuples():
+            jobs.append({'image1': SpatialIndexLS8.scene_url(scene_list.loc[pair.idx1, 'prefix'], self.band),
+                         'image2': SpatialIndexLS8.scene_url(scene_list.loc[pair.idx2, 'prefix'], self.band),
+                         'image1_date': pd.Timestamp(pair.time1).strftime('%Y-%m-%d'),
+                         'image2_date': pd.Timestamp(pair.time2).strftime('%Y-%m-%d'),
+                         'baseline': float(pair.baseline),
+                         'output': self.pair_output(pair.time1, pair.time2, ini),
+                         'status': 'pending',
+                         'error': None})
+        if self.store and len(pairs):
+            first = pairs.loc[pairs['time1'].idxmin()]
+            grid = overlap_params([SpatialIndexLS8.scene_url(scene_list.loc[first['idx1'], 'prefix'], self.band)], aoi=self.aoi)
+            for job, pair in zip(jobs, pairs.itertuples()):
+                job['store'] = self.pair_store(scene_list.loc[pair.idx1, 'prefix'], grid)
+        for job in jobs:
+            if os.path.exists(job['output']) and (job.get('store') is None
+                                                  or job['store'].has_pair(job['image1_date'], job['image2_date'])):
+                job['status'] = 'skipped'
+        self.manifest = {'band': self.band, 'kernel': self.kernel, 'jobs': jobs}
+        self.write_manifest()
+
+        todo = [job for job in jobs if job['status'] == 'pending']
+        if todo:
+            if not self.store:
+                first = pairs.loc[pairs['time1'].idxmin()]
+                grid = overlap_params([SpatialIndexLS8.scene_url(scene_list.loc[first['idx1'], 'prefix'], self.band)], aoi=self.aoi)
+            prepared = self.prepare_scenes(sorted(set([job['image1'] for job in todo] + [job['image2'] for job in todo])), grid, ini)
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {}
+                for job in todo:
+                    if not (prepared[job['image1']] and prepared[job['image2']]):
+                        job['status'] = 'failed'
+                        job['error'] = 'preprocessing failed'
+                        continue
+                    futures[pool.submit(_run_pair, job['image1'], job['image1_date'], job['image2'], job['image2_date'],
+                                        self.new_params(), self.kernel, self.cache, grid, job.get('store'), self.aoi)] = job
+                pending = set(futures)
+                while pending:
+                    finished, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                    if cancel is not None and cancel.is_set():
+                        for future in pending:
+                            future.cancel()
+                    for future in finished:
+                        job = futures[future]
+                        if future.cancelled():
+                            job['status'] = 'cancelled'
+                            continue
+                        job['error'] = future.result()
+                        if job['error'] is None and os.path.exists(job['output']):
+                            job['status'] = 'done'
+                        else:
+                            job['status'] = 'failed'
+                            print('Feature tracking failed: ' + job['image1_date'] + ' - ' + job['image2_date'] + ' (' + str(job['error']) + ')')
+                    if finished:
+                        if progress is not None:
+                            progress(len(futures) - len(pending), len(futures))
+                        self.write_manifest()
+            self.write_manifest()
+        return pd.DataFrame(jobs)
+
+    def prepare_scenes(self, urls, grid, ini):
+        """
+        Put every scene into the preprocessing cache, once.
+        output:
+            {url: True if the scene is ready, False otherwise}
+        """
+        hp_sigma = None
+        if self.kernel != 'ncc' and ini.pxsettings['gaussian_hp']:
+            hp_sigma = ini.pxsettings['gaussian_hp_sigma']
+
+        def prepare(url):
+            try:
+                self.cache.prepare(url, grid=grid, gaussian_hp_sigma=hp_sigma, ampcor_prep=self.kernel != 'ncc')
+                return True
+            except Exception as e:
+                print('Cannot preprocess ' + url + ' (' + str(e) + ')')
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return dict(zip(urls, pool.map(prepare, urls)))
+
+    def write_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1, default=lambda store: store.path)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def _run_pair(file1, file1_date, file2, file2_date, ini, kernel, cache, grid, store=None, aoi=None):
+    """
+    One job of BatchFeatureTrack (in a worker process). Returns None or an error message.
+    """
+    try:
+        if store is None:
+            carst_featuretrack(file1, file1_date, file2, file2_date, params=ini, kernel=kernel, cache=cache, grid=grid, aoi=aoi)
+        else:
+            result = carst_featuretrack(file1, file1_date, file2, file2_date, params=ini, kernel=kernel, cache=cache,
+                                        grid=grid, aoi=aoi, in_memory=True, store=store)
+            if result is not None:
+                result[1].close()
+    except Exception as e:
+        return str(e)
+    return None
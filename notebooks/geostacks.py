@@ -1,33 +1,112 @@
 import os
+import json
+import pickle
+import time
 import pandas as pd
 import geopandas as gpd
 import itertools
-from shapely.geometry import Point, Polygon, MultiPolygon, box
+import shapely
+from shapely.geometry import Point, box
 import numpy as np
 from sklearn.neighbors import BallTree
 import requests
+import asyncio
+import aiohttp
 import boto3
 import botocore
-from datetime import datetime
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from lruindex import LRUIndex
+
+
+class CatalogCache:
+    """
+    A local SQLite store of catalog search results, such as the scene
+    prefixes of a LS8 Path/Row or the ITS_LIVE granule URLs of a query.
+    Entries are keyed by the kind of search plus its normalized parameters.
+
+    ttl:       seconds before an entry is considered stale (None: never).
+    max_bytes: total size of the stored results; least recently used
+               entries are evicted beyond it (None: unbounded).
+    offline:   never go to the network. Stale entries are still returned,
+               and missing entries give an empty result.
+    """
+
+    def __init__(self, fname='catalog_cache.sqlite', ttl=86400,
+                 max_bytes=256 * 1024 ** 2, offline=False):
+
+        self.fname = fname
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.index = LRUIndex(fname, 'catalog', max_bytes=max_bytes)
+
+    @staticmethod
+    def make_key(kind, params):
+        params = {str(k): str(v) for k, v in params.items()}
+        return kind + ':' + json.dumps(params, sort_keys=True)
+
+    def get(self, key):
+        """
+        Return the cached value of a key, or None if it is missing or stale.
+        """
+        record = self.index.get(key)
+        if record is None:
+            return None
+        value, created = record
+        if (not self.offline and self.ttl is not None
+                and time.time() - created > self.ttl):
+            return None
+        return json.loads(value)
+
+    def put(self, key, value):
+        value = json.dumps(value)
+        self.index.put(key, value, len(value))
+
+    def fetch(self, key, func, default=None):
+        """
+        Return the cached value of a key. Otherwise call func(), store and
+        return its result. In offline mode, default is returned instead.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        if self.offline:
+            print('Offline mode: no cached result for ' + key)
+            return default
+        value = func()
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        self.index.clear()
 
 
 class SpatialIndex:
 
-    def __init__(self, fname=None):
+    def __init__(self, fname=None, cache=None):
 
         self.fname = fname
+        self.cache = cache        # an optional CatalogCache
         self.corner_pts_df = None
         self.footprint = None
+        self.balltree = None
+        self.prepared_geometries = None
+        self.pathrow_labels = None    # 'PPP/RRR' of every footprint
+        self._query_cache = None
 
     @staticmethod
     def _check_crossing(lon_list):
         """
         Checks if the antimeridian is crossed.
         lon_list has four elements: [lon_UL, lon_UR, lon_LR, lon_LL]
-        which defines an image boundary.
+        which defines an image boundary. It can also be an (N, 4) array,
+        in which case a boolean mask of N elements is returned.
+        Any two corners being more than 180 degrees apart is the same as
+        the max-min span of the four corners exceeding 180 degrees.
         """
-        return any(abs(pair[0] - pair[1]) >
-                   180.0 for pair in itertools.combinations(lon_list, 2))
+        return np.ptp(np.asarray(lon_list, dtype=float), axis=-1) > 180.0
 
 
 class SpatialIndexLS8(SpatialIndex):
@@ -38,33 +117,33 @@ class SpatialIndexLS8(SpatialIndex):
         If the polygon runs across the antimeridian, The polygon will be
         separated into two adjacent polygons along the antimeridian, and these
         two polygons will be grouped into a single MultiPolygon object.
+        All of the polygons are created at once from the corner columns.
         """
-        geometry_collection = []
-        for index, row in self.corner_pts_df.iterrows():
-            lon_list = [row.lon_UL, row.lon_UR, row.lon_LR, row.lon_LL]
-            if self._check_crossing(lon_list):
-                set1 = [x % 360.0 for x in lon_list]
-                set2 = [x % -360.0 for x in lon_list]
-                poly1 = Polygon([(set1[0], row.lat_UL),
-                                 (set1[1], row.lat_UR),
-                                 (set1[2], row.lat_LR),
-                                 (set1[3], row.lat_LL)])
-                poly2 = Polygon([(set2[0], row.lat_UL),
-                                 (set2[1], row.lat_UR),
-                                 (set2[2], row.lat_LR),
-                                 (set2[3], row.lat_LL)])
-                feature_geometry = MultiPolygon([poly1, poly2])
-            else:
-                feature_geometry = Polygon([(row.lon_UL, row.lat_UL),
-                                            (row.lon_UR, row.lat_UR),
-                                            (row.lon_LR, row.lat_LR),
-                                            (row.lon_LL, row.lat_LL)])
-            geometry_collection.append(feature_geometry)
+        df = self.corner_pts_df
+        lons = df[['lon_UL', 'lon_UR', 'lon_LR', 'lon_LL']].to_numpy(float)
+        lats = df[['lat_UL', 'lat_UR', 'lat_LR', 'lat_LL']].to_numpy(float)
+        crossing = self._check_crossing(lons)
+
+        geometry_collection = shapely.polygons(np.stack((lons, lats),
+                                                        axis=-1))
+        if crossing.any():
+            lons_x = lons[crossing]
+            lats_x = lats[crossing]
+            poly1 = shapely.polygons(np.stack((lons_x % 360.0, lats_x),
+                                              axis=-1))
+            poly2 = shapely.polygons(np.stack((lons_x % -360.0, lats_x),
+                                              axis=-1))
+            geometry_collection[crossing] = shapely.multipolygons(
+                np.stack((poly1, poly2), axis=-1))
 
         return geometry_collection
 
     def read(self):
         
+        if os.path.isdir(self.fname):
+            # a prebuilt index written by save()
+            self.load()
+            return
         if self.fname.endswith('.xls'):
             self.corner_pts_df = pd.read_excel(self.fname)
         elif self.fname.endswith('.csv'):
@@ -78,49 +157,220 @@ class SpatialIndexLS8(SpatialIndex):
         self.footprint = self.footprint.drop(['lat_UL', 'lon_UL', 'lat_UR',
                                               'lon_UR', 'lat_LL', 'lon_LL',
                                               'lat_LR', 'lon_LR'], axis=1)
+        self.build_index()
+
+    def build_index(self):
+        """
+        Build the ball tree of all LS8 center points and prepare all of the
+        footprint geometries, so that both are created only once instead of
+        at every query.
+        sklearn's haversine metric takes [lat, lon] in radians.
+        """
+        centers = np.vstack((self.footprint.lat_CTR.values,
+                             self.footprint.lon_CTR.values)).T
+        self.balltree = BallTree(np.radians(centers), metric='haversine')
+        self.prepare_geometries()
+
+    def prepare_geometries(self):
+        self.prepared_geometries = self.footprint.geometry.to_numpy()
+        shapely.prepare(self.prepared_geometries)
+        self.build_labels()
+        self._query_cache = None
+
+    def build_labels(self):
+        """
+        Create the 'PPP/RRR' label of every footprint once, for the menus.
+        """
+        self.pathrow_labels = (
+            self.footprint['path'].astype(int).astype(str).str.zfill(3) + '/'
+            + self.footprint['row'].astype(int).astype(str).str.zfill(3))
+
+    def pathrow_options(self, idxs):
+        """
+        Return [('PPP/RRR', index), ...] of the footprints in idxs, ready
+        to be used as widget options.
+        """
+        if self.pathrow_labels is None:
+            self.build_labels()
+        return list(zip(self.pathrow_labels.loc[list(idxs)].tolist(), idxs))
+
+    def save(self, path):
+        """
+        Write the footprint as a binary index directory, so that later
+        sessions can skip parsing the corner point file.
+        The directory contains:
+            index.json          column names and format version
+            <column>.npy        one array per attribute column (path, row, ...)
+            geometry_wkb.npy    all of the footprint geometries as WKB bytes
+            geometry_offs.npy   start/end of each geometry in geometry_wkb.npy
+            balltree.pkl        the ball tree of the center points
+        """
+        if self.balltree is None:
+            self.build_index()
+        os.makedirs(path, exist_ok=True)
+        columns = [c for c in self.footprint.columns if c != 'geometry']
+        for col in columns:
+            np.save(os.path.join(path, col + '.npy'),
+                    self.footprint[col].to_numpy())
+        wkb = shapely.to_wkb(self.footprint.geometry.to_numpy())
+        offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(i) for i in wkb])
+        np.save(os.path.join(path, 'geometry_wkb.npy'),
+                np.frombuffer(b''.join(wkb), dtype=np.uint8))
+        np.save(os.path.join(path, 'geometry_offs.npy'), offsets)
+        with open(os.path.join(path, 'balltree.pkl'), 'wb') as f:
+            pickle.dump(self.balltree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'version': 1, 'columns': columns}, f)
+
+    def load(self, path=None, mmap_mode=None):
+        """
+        Read a binary index directory written by save().
+        mmap_mode is passed to np.load; use 'r' to memory-map the arrays
+        instead of reading them into memory.
+        """
+        if path is None:
+            path = self.fname
+        with open(os.path.join(path, 'index.json')) as f:
+            meta = json.load(f)
+        table = {col: np.load(os.path.join(path, col + '.npy'),
+                              mmap_mode=mmap_mode)
+                 for col in meta['columns']}
+        buf = np.load(os.path.join(path, 'geometry_wkb.npy'),
+                      mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(path, 'geometry_offs.npy'))
+        wkb = [buf[i:j].tobytes() for i, j in zip(offsets[:-1], offsets[1:])]
+        self.footprint = gpd.GeoDataFrame(table,
+                                          geometry=shapely.from_wkb(wkb))
+        try:
+            with open(os.path.join(path, 'balltree.pkl'), 'rb') as f:
+                self.balltree = pickle.load(f)
+        except Exception as e:
+            # e.g., written by an incompatible scikit-learn version
+            print('Cannot read the saved ball tree, rebuilding it: ', e)
+            self.build_index()
+            return
+        self.prepare_geometries()
 
     def query_pathrow(self, point_geometry):
         '''
         Query available LS8 Path/Row combinations for a point in [lon, lat].
+        This is a single-point wrapper of query_pathrows.
+
+        input:
+            points_geometry: 2-element list showing [lon, lat], or a Point
+            self.footprint (polygon_data): the LS8 footprint (GeoDataFrame)
+        output:
+            selection_idx: index numbers for the right Path/Row.
+        '''
+        if type(point_geometry) is Point:
+            point_geometry = [point_geometry.x, point_geometry.y]
+        return self.query_pathrows([point_geometry])[0]
+
+    # query_pathrow_cached: points are rounded to this many decimals of a
+    # degree (~100 m), and the results of this many points are kept
+    pathrow_cache_decimals = 3
+    pathrow_cache_size = 256
+
+    def query_pathrow_cached(self, point_geometry):
+        '''
+        query_pathrow for a point rounded to pathrow_cache_decimals, with
+        the results of recently queried points in an LRU cache, e.g., for
+        a map marker that is dragged around.
+        '''
+        if type(point_geometry) is Point:
+            point_geometry = [point_geometry.x, point_geometry.y]
+        if self._query_cache is None:
+            self._query_cache = functools.lru_cache(
+                maxsize=self.pathrow_cache_size)(self._query_rounded)
+        lon, lat = (round(float(i), self.pathrow_cache_decimals)
+                    for i in point_geometry)
+        return list(self._query_cache(lon, lat))
+
+    def _query_rounded(self, lon, lat):
+        return tuple(self.query_pathrow([lon, lat]))
+
+    def query_pathrows(self, points):
+        '''
+        Query available LS8 Path/Row combinations for many points at once.
         We use a two-step process:
         (1) a ball tree search for all of the LS8 center points that are
-            within 0.05 radians (~2.85 degrees) from the query point.
-        (2) a point-in-polygon search using the results from (1).
+            within 0.05 radians (~2.85 degrees) from each query point.
+        (2) a point-in-polygon search using the results from (1), done for
+            all of the candidates at once against the prepared footprints.
+            Antimeridian MultiPolygons are tested as a whole.
 
         input:
-            points_geometry: 2-element list showing [lon, lat]
+            points: (N, 2) array-like of [lon, lat]
             self.footprint (polygon_data): the LS8 footprint (GeoDataFrame)
         output:
-            selection_idx: index numbers for the right Path/Row.
+            selection_idxs: a list of N lists, each containing the index
+                            numbers for the right Path/Row of that point.
         '''
+        if self.balltree is None:
+            self.build_index()
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if points.shape[0] == 0:
+            return []
 
         # (1) Ball Tree
-        points = np.vstack((self.footprint.lon_CTR.values,
-                            self.footprint.lat_CTR.values)).T
-        points *= np.pi/180.
-        LSBall = BallTree(points, metric='haversine')
+        q = np.radians(points[:, ::-1])
+        pre_selection = self.balltree.query_radius(q, r=0.05,
+                                                   return_distance=False)
 
-        q = np.array(point_geometry)
-        q *= np.pi/180.
-        if type(point_geometry) is Point:
-            pt = point_geometry
-        else:
-            pt = Point(point_geometry)
+        # (2) Point-in-polygon, tested for all (point, candidate) pairs at once
+        counts = [len(idx) for idx in pre_selection]
+        pt_idx = np.repeat(np.arange(points.shape[0]), counts)
+        fp_idx = np.concatenate(pre_selection).astype(int)
+        inside = shapely.contains_xy(self.prepared_geometries[fp_idx],
+                                     points[pt_idx, 0], points[pt_idx, 1])
+        pt_idx = pt_idx[inside]
+        fp_idx = fp_idx[inside]
+        order = np.lexsort((fp_idx, pt_idx))
+        pt_idx = pt_idx[order]
+        fp_idx = fp_idx[order]
+        split_at = np.searchsorted(pt_idx, np.arange(1, points.shape[0]))
+        index = self.footprint.index.values
+        selection_idxs = [list(index[idx]) for idx in
+                          np.split(fp_idx, split_at)]
 
-        pre_selection = LSBall.query_radius(q.reshape(1, -1),
-                                            r=0.05,
-                                            return_distance=False)
-        pre_selection_idx = pre_selection[0]
-        pre_selection_idx.sort()
-        polygon_pre_selection = self.footprint.loc[pre_selection_idx]
+        return selection_idxs
 
-        # (2) Point-in-polygon
-        selection_idx = []
-        for idx, row in polygon_pre_selection.iterrows():
-            if pt.within(row.geometry):
-                selection_idx.append(idx)
+    # one boto3 client is shared by all of the searches (clients are
+    # thread-safe), with a connection pool large enough for search_s3_many.
+    _s3_client = None
+    _s3_client_lock = threading.Lock()
+    s3_max_pool_connections = 32
 
-        return selection_idx
+    @classmethod
+    def get_s3_client(cls):
+        with cls._s3_client_lock:
+            if cls._s3_client is None:
+                # according to https://github.com/boto/boto3/issues/1200
+                cls._s3_client = boto3.client(
+                    's3', region_name='us-west-2',
+                    config=botocore.config.Config(
+                        signature_version=botocore.UNSIGNED,
+                        max_pool_connections=cls.s3_max_pool_connections))
+        return cls._s3_client
+
+    @classmethod
+    def list_s3_prefixes(cls, s3_prefix):
+        """
+        List all of the scene prefixes (folders) under s3_prefix.
+        Follows the continuation tokens, so that path/rows with more than
+        1000 scenes are not cut off.
+        """
+        # https://towardsdatascience.com/
+        #        working-with-amazon-s3-buckets-with-boto3-785252ea22e0
+        paginator = cls.get_s3_client().get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket="landsat-pds", Prefix=s3_prefix,
+                                   Delimiter='/')
+        scene_prefixes = []
+        for page in pages:
+            for scene in page.get('CommonPrefixes') or []:
+                scene_prefixes.append(scene.get('Prefix'))
+        return scene_prefixes
 
     def search_s3(self, pr_idx):
         s3_pathrow = '{:03d}/{:03d}'.format(self.footprint.loc[pr_idx].path,
@@ -128,42 +378,72 @@ class SpatialIndexLS8(SpatialIndex):
         s3_prefix = 'c1/L8/' + s3_pathrow + '/LC08_L1TP_'
         # print(s3_prefix)
 
-        # according to https://github.com/boto/boto3/issues/1200
-        s3 = boto3.client('s3', region_name='us-west-2',
-                          config=botocore.config.Config(
-                            signature_version=botocore.UNSIGNED))
+        if self.cache is None:
+            scene_prefixes = self.list_s3_prefixes(s3_prefix)
+        else:
+            key = CatalogCache.make_key('landsat-pds', {'prefix': s3_prefix})
+            scene_prefixes = self.cache.fetch(
+                key, lambda: self.list_s3_prefixes(s3_prefix), default=[])
+        scene_list = self.build_scene_list(scene_prefixes)
+        return s3_prefix, scene_list
 
-        # https://towardsdatascience.com/
-        #        working-with-amazon-s3-buckets-with-boto3-785252ea22e0
-        response = s3.list_objects_v2(Bucket="landsat-pds", MaxKeys=1000,
-                                      Prefix=s3_prefix, Delimiter='/')
+    @staticmethod
+    def build_scene_list(scene_prefixes):
+        """
+        Build the scene list from S3 scene prefixes in one go.
+        A prefix looks like
+        c1/L8/009/011/LC08_L1TP_009011_20180612_20180615_01_T1/
+        and gives the acquisition date (datetime64) and the tier (category).
+        """
+        prefixes = pd.Series(scene_prefixes, dtype=object)
+        if prefixes.empty:
+            time = pd.Series([], dtype='datetime64[ns]')
+            tier = pd.Series([], dtype=object)
+        else:
+            components = prefixes.str.split('_', expand=True)
+            time = pd.to_datetime(components[3], format='%Y%m%d')
+            tier = components[6].str[:-1]
+        return pd.DataFrame({'prefix': prefixes,
+                             'time': time,
+                             'tier': tier.astype('category')})
 
-        scene_list = pd.DataFrame(columns=('prefix', 'time', 'tier'))
-        scene_idx = 0
+    @staticmethod
+    def scene_options(scene_list, tier='T1'):
+        """
+        Return [(date string, scene_list index), ...] of the scenes in a
+        given tier, ready to be used as widget options.
+        """
+        selected = scene_list.loc[scene_list['tier'] == tier, 'time']
+        return list(zip(selected.dt.strftime('%Y-%m-%d'), selected.index))
 
-        if response.get('CommonPrefixes') is None:
-            # print('No available scenes!')
-            pass
-        else:
-            for scene in response.get('CommonPrefixes'):
-                scene_prefix = scene.get('Prefix')
-                # print(scene.get('Prefix'))
-                timestamp = scene_prefix.split('_')[3]
-                timestamp = datetime.strptime(timestamp, '%Y%m%d')
-                timestamp = timestamp.date()
-                tierstate = scene_prefix.split('_')[6][:-1]
-                # print(timestamp, tierstate)
-                scene_list.loc[scene_idx] = [scene_prefix,
-                                             timestamp, tierstate]
-                scene_idx += 1
+    @staticmethod
+    def scene_url(prefix, band):
+        """
+        URL of one band of a scene, e.g.
+        https://landsat-pds.s3.amazonaws.com/c1/L8/009/011/
+        LC08_L1TP_009011_20180612_20180615_01_T1/
+        LC08_L1TP_009011_20180612_20180615_01_T1_B8.TIF
+        """
+        return ('https://landsat-pds.s3.amazonaws.com/' + prefix
+                + os.path.basename(prefix[:-1]) + '_' + band + '.TIF')
 
-        return s3_prefix, scene_list
+    def search_s3_many(self, pr_indices, max_workers=16):
+        """
+        Run search_s3 for many path/rows concurrently using a thread pool.
+        Returns a dict of {pr_idx: (s3_prefix, scene_list)}.
+        """
+        pr_indices = list(pr_indices)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(self.search_s3, pr_indices))
+        return dict(zip(pr_indices, results))
 
 
 class SpatialIndexITSLIVE(SpatialIndex):
     # modified from https://github.com/nasa-jpl/itslive
+    base_url = 'https://nsidc.org/apps/itslive-search/velocities/urls'
+
     @staticmethod
-    def get_granule_urls(params):
+    def get_granule_urls(params, cache=None):
         '''
         params example:
         params = {'polygon': '-50.0783,69.6975,-50.0783,69.6995,
@@ -171,10 +451,18 @@ class SpatialIndexITSLIVE(SpatialIndex):
                               -50.0783,69.6975',
             'percent_valid_pixels': 1, 'start': '2017-08-29',
                                         'end': '2019-03-31'}
+        cache: an optional CatalogCache.
         '''
-        base_url = 'https://nsidc.org/apps/itslive-search/velocities/urls'
-        resp = requests.get(base_url, params=params, verify=False)
-        return resp.json()
+        def search():
+            resp = requests.get(SpatialIndexITSLIVE.base_url, params=params,
+                                verify=False)
+            resp.raise_for_status()    # never cache an error payload
+            return resp.json()
+
+        if cache is None:
+            return search()
+        key = CatalogCache.make_key('itslive', params)
+        return cache.fetch(key, search, default=[])
 
     @staticmethod
     def get_minimal_bbox(query_pt):
@@ -192,45 +480,179 @@ class SpatialIndexITSLIVE(SpatialIndex):
         bbox = box(lon - lon_offset,
                    lat - lat_offset,
                    lon + lon_offset, lat + lat_offset)
+        return SpatialIndexITSLIVE.format_polygon(bbox)
+
+    @staticmethod
+    def format_polygon(polygon):
+        """
+        Format a shapely Polygon as the 'polygon' parameter of a search:
+        'lon1,lat1,lon2,lat2,...'
+        """
         coords = [[str(float("{:.4f}".format(coord[0]))),
                    str(float("{:.4f}".format(coord[1])))]
-                  for coord in bbox.exterior.coords]
+                  for coord in polygon.exterior.coords]
         coords = list(itertools.chain.from_iterable(coords))
         return ','.join(coords)
 
+    @staticmethod
+    def get_granule_urls_many(queries, windows, percent_valid_pixels=1,
+                              max_concurrency=8, retries=3, cache=None,
+                              parse=True, **kwargs):
+        '''
+        Search for granules of many query geometries and date windows at
+        once. Every (query, window) combination is one request; requests run
+        concurrently through a shared aiohttp session.
+
+        queries: a list of [lon, lat] points, shapely Polygons, or polygon
+                 strings as used by get_granule_urls.
+        windows: a list of (start, end) date strings, e.g.
+                 [('2017-01-01', '2017-12-31'), ...]
+        max_concurrency: maximum number of requests in flight.
+        retries: number of retries of a failed request.
+        cache: an optional CatalogCache.
+        kwargs: other search parameters, e.g., time_delta.
+        output:
+            a parse_urls-style dict of all of the unique granules, or the
+            list of the unique url dicts if parse is False.
+        '''
+        params_list = []
+        for query in queries:
+            if isinstance(query, str):
+                polygon = query
+            elif isinstance(query, Point):
+                polygon = SpatialIndexITSLIVE.get_minimal_bbox(
+                    [query.x, query.y])
+            elif hasattr(query, 'exterior'):
+                polygon = SpatialIndexITSLIVE.format_polygon(query)
+            else:
+                polygon = SpatialIndexITSLIVE.get_minimal_bbox(query)
+            for start, end in windows:
+                params = {'polygon': polygon,
+                          'percent_valid_pixels': percent_valid_pixels,
+                          'start': start, 'end': end}
+                params.update(kwargs)
+                params_list.append({k: str(v) for k, v in params.items()})
+
+        responses = _run_coroutine(SpatialIndexITSLIVE._fetch_granule_urls(
+            params_list, max_concurrency, retries, cache))
+
+        urls = []
+        seen = set()
+        for response in responses:
+            for url_dict in response:
+                if url_dict['url'] not in seen:
+                    seen.add(url_dict['url'])
+                    urls.append(url_dict)
+        if parse:
+            return SpatialIndexITSLIVE.parse_urls(urls)
+        return urls
+
+    @staticmethod
+    async def _fetch_granule_urls(params_list, max_concurrency, retries,
+                                  cache):
+        semaphore = asyncio.Semaphore(max_concurrency)
+        # ssl=False is the same as verify=False in get_granule_urls
+        connector = aiohttp.TCPConnector(limit=max_concurrency, ssl=False)
+        timeout = aiohttp.ClientTimeout(total=300)
+
+        async def fetch(session, params):
+            if cache is not None:
+                key = CatalogCache.make_key('itslive', params)
+                urls = cache.get(key)
+                if urls is not None:
+                    return urls
+                if cache.offline:
+                    print('Offline mode: no cached result for ' + key)
+                    return []
+            async with semaphore:
+                for attempt in range(retries + 1):
+                    try:
+                        async with session.get(SpatialIndexITSLIVE.base_url,
+                                               params=params) as resp:
+                            resp.raise_for_status()
+                            urls = await resp.json(content_type=None)
+                        break
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        if attempt == retries:
+                            raise
+                        await asyncio.sleep(2 ** attempt)
+            if cache is not None:
+                cache.put(key, urls)
+            return urls
+
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=timeout) as session:
+            return await asyncio.gather(*[fetch(session, params)
+                                          for params in params_list])
+
+    @staticmethod
+    def granule_table(urls):
+        '''
+        Parse the granule urls into a table, with one row per granule:
+            url, pathrow ('PPP/RRR'), start_date, end_date, mid_date
+            (datetime64), pair_days (int), img1_tier, img2_tier.
+        A granule file name looks like
+        LC08_L1TP_009011_20180730_20180814_01_T1_X_
+            LC08_L1TP_009011_20180612_20180615_01_T1_G0240V01_P086.nc
+        where the second image (the later one) comes first.
+        '''
+        url = pd.Series([url_dict['url'] for url_dict in urls], dtype=object)
+        columns = ['url', 'pathrow', 'start_date', 'end_date', 'mid_date',
+                   'pair_days', 'img1_tier', 'img2_tier']
+        if url.empty:
+            return pd.DataFrame(columns=columns).astype(
+                {'start_date': 'datetime64[ns]', 'end_date': 'datetime64[ns]',
+                 'mid_date': 'datetime64[ns]', 'pair_days': int,
+                 'img1_tier': 'category', 'img2_tier': 'category'})
+        file_components = url.str.rsplit('/', n=1).str[-1].str.split(
+            '_', expand=True)
+        prstr = file_components[2]
+        start_date = pd.to_datetime(file_components[11], format='%Y%m%d')
+        end_date = pd.to_datetime(file_components[3], format='%Y%m%d')
+        pair_length = end_date - start_date
+        table = pd.DataFrame({
+            'url': url,
+            'pathrow': prstr.str[:3] + '/' + prstr.str[-3:],
+            'start_date': start_date,
+            'end_date': end_date,
+            'mid_date': start_date + pair_length / 2,
+            'pair_days': pair_length.dt.days,
+            'img1_tier': file_components[14].astype('category'),
+            'img2_tier': file_components[6].astype('category')})
+        return table[columns]
+
     @staticmethod
     def parse_urls(urls):
         '''
-        parse urls
+        parse urls into {'PPP/RRR': [{'entrystr': ..., 'url': ...}, ...]}
+        for the UI menu. This is a view of granule_table, sorted by dates.
         '''
+        table = SpatialIndexITSLIVE.granule_table(urls)
+        # For now let's show results using T1 images only
+        table = table.loc[(table['img1_tier'] != 'RT') &
+                          (table['img2_tier'] != 'RT')]
+        table = table.sort_values(['start_date', 'end_date'], kind='stable')
+        entrystr = (table['start_date'].dt.strftime('%Y-%m-%d') + ' / ' +
+                    table['end_date'].dt.strftime('%Y-%m-%d') + ' / ' +
+                    table['pair_days'].astype(str) + ' days')
+
         pr_dict = {}
-        for url_dict in urls:
-            file_name = os.path.basename(url_dict['url'])
-            file_components = file_name.split('_')
-            prstr = file_components[2]
-            prstr = prstr[:3] + '/' + prstr[-3:]
-            start_date = datetime.strptime(file_components[11],
-                                           "%Y%m%d").date()
-            end_date = datetime.strptime(file_components[3],
-                                         "%Y%m%d").date()
-            pair_days = end_date - start_date
-            img1_tier = file_components[14]
-            img2_tier = file_components[6]
-            # For now let's show results using T1 images only
-            if img1_tier != 'RT' and img2_tier != 'RT':
-                # if prstr == '083/232':
-                #     print(url_dict['url'])
-                start_date_str = start_date.strftime('%Y-%m-%d')
-                end_date_str = end_date.strftime('%Y-%m-%d')
-                entrystr = ' / '.join((start_date_str,
-                                       end_date_str,
-                                       f'{pair_days.days} days'))
-                pr_dict_entry = {'entrystr': entrystr, 'url': url_dict['url']}
-                if prstr in pr_dict:
-                    pr_dict[prstr].append(pr_dict_entry)
-                else:
-                    pr_dict[prstr] = [pr_dict_entry]
-
-        for key in pr_dict:
-            pr_dict[key].sort(key=lambda x: x.get('entrystr'))
+        for prstr, entry, url in zip(table['pathrow'], entrystr,
+                                     table['url']):
+            pr_dict.setdefault(prstr, []).append({'entrystr': entry,
+                                                  'url': url})
         return pr_dict
+
+
+def _run_coroutine(coro):
+    """
+    Run a coroutine to completion and return its result. Inside Jupyter an
+    event loop is already running, so the coroutine is run in its own loop
+    on a separate thread instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
@@ -0,0 +1,98 @@
+# A SQLite index of cache entries with least-recently-used eviction,
+# shared by geostacks.CatalogCache and prepcache.PreprocessCache.
+
+import sqlite3
+import time
+from contextlib import closing
+
+
+class LRUIndex:
+    """
+    A table of cache entries (key, value, size, created, accessed) in a
+    SQLite file. There is one connection per call, so that the index can be
+    shared by threads and processes.
+
+    table:     name of the table.
+    column:    name of the value column (e.g., 'value' or 'fpath').
+    max_bytes: total size of the entries; least recently used entries are
+               evicted beyond it (None: unbounded).
+    """
+
+    def __init__(self, fname, table, column='value', max_bytes=None,
+                 timeout=30):
+
+        self.fname = fname
+        self.table = table
+        self.column = column
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        with closing(self.connect()) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS {} ('
+                         'key TEXT PRIMARY KEY, {} TEXT, size INTEGER, '
+                         'created REAL, accessed REAL)'.format(table, column))
+
+    def connect(self):
+        return sqlite3.connect(self.fname, timeout=self.timeout)
+
+    def get(self, key, touch=True):
+        """
+        Return (value, created) of a key, or None if it is missing.
+        touch: mark the entry as used now.
+        """
+        with closing(self.connect()) as conn, conn:
+            record = conn.execute('SELECT {}, created FROM {} WHERE key = ?'
+                                  .format(self.column, self.table),
+                                  (key,)).fetchone()
+            if record is not None and touch:
+                conn.execute('UPDATE {} SET accessed = ? WHERE key = ?'
+                             .format(self.table), (time.time(), key))
+        return record
+
+    def put(self, key, value, size, protect=()):
+        """
+        Add or replace an entry, then evict the least recently used entries
+        beyond max_bytes. The new entry and the keys in protect are never
+        evicted. Returns the evicted [(key, value), ...], so that the caller
+        can remove their data.
+        """
+        now = time.time()
+        with closing(self.connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?)'
+                         .format(self.table), (key, value, size, now, now))
+            if self.max_bytes is None:
+                return []
+            return self._evict(conn, set(protect) | {key})
+
+    def _evict(self, conn, protect):
+        total, = conn.execute('SELECT COALESCE(SUM(size), 0) FROM {}'
+                              .format(self.table)).fetchone()
+        evicted = []
+        if total <= self.max_bytes:
+            return evicted
+        records = conn.execute('SELECT key, {}, size FROM {} ORDER BY accessed'
+                               .format(self.column, self.table)).fetchall()
+        for key, value, size in records:
+            if key in protect:
+                continue
+            conn.execute('DELETE FROM {} WHERE key = ?'.format(self.table),
+                         (key,))
+            evicted.append((key, value))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        return evicted
+
+    def delete(self, key):
+        with closing(self.connect()) as conn, conn:
+            conn.execute('DELETE FROM {} WHERE key = ?'.format(self.table),
+                         (key,))
+
+    def clear(self):
+        """
+        Remove all of the entries and return them as [(key, value), ...].
+        """
+        with closing(self.connect()) as conn, conn:
+            records = conn.execute('SELECT key, {} FROM {}'.format(
+                self.column, self.table)).fetchall()
+            conn.execute('DELETE FROM {}'.format(self.table))
+        return records
@@ -0,0 +1,299 @@
+# In-process normalized cross-correlation (NCC) feature tracking kernel.
+# An alternative to ISCE's ampcor that only needs NumPy. The output uses
+# the same layout as CARST's writeout_ampcor_task, so the rest of the
+# CARST workflow (AmpcoroffFile) works unchanged.
+
+import pickle
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import gaussian_filter
+
+
+def ncc_offsets(img1, img2, pxsettings, batch_size=1024,
+                nodata=(0.0, -9999.0), rows=None):
+    """
+    Track features from img1 to img2 (2-D arrays on the same grid).
+
+    pxsettings uses the same keys as FTParams.pxsettings:
+        refwindow_x/y:    size of the reference chip from img1
+        searchwindow_x/y: search range (in pixels) on each side of the chip
+        skip_across/down: spacing of the reference chips
+        oversampling:     subpixel offsets are rounded to 1/oversampling
+    The correlation surfaces of batch_size chips are computed at once with
+    FFTs. Chips that touch a nodata value (or NaN) are skipped, as well as
+    chips whose correlation peak is on the edge of the search range.
+    rows: the upper-left rows of the reference chips (default: every
+          skip_down rows); used by ncc_offsets_tiled.
+
+    output: an N-by-8 array in the ampcor layout
+        column 1: x cell # (1-based, center of the reference chip)
+        column 2: offset along across (x) direction, in pixels
+        column 3: y cell # (1-based, center of the reference chip)
+        column 4: offset along down (y) direction, in pixels
+        column 5: SNR ratio (correlation peak / mean absolute correlation)
+        column 6: Cov 1 (x), column 7: Cov 2 (y), column 8: Cov 3 (xy),
+                  in pixels^2
+    """
+    h, w = pxsettings['refwindow_y'], pxsettings['refwindow_x']
+    sy, sx = pxsettings['searchwindow_y'], pxsettings['searchwindow_x']
+    skip_x = pxsettings['skip_across']
+    oversampling = pxsettings['oversampling']
+
+    img1 = np.asarray(img1, dtype=float)
+    img2 = np.asarray(img2, dtype=float)
+    if img1.shape != img2.shape:
+        raise ValueError('The two images need to have the same size.')
+    check_image_size(img1.shape, pxsettings)
+    ny, nx = img1.shape
+
+    # upper-left corners of the reference chips; the search area of each
+    # chip needs to be inside img2.
+    y0 = chip_rows(ny, pxsettings) if rows is None else np.asarray(rows)
+    x0 = np.arange(sx, nx - w - sx + 1, skip_x)
+    ty, tx = [i.ravel() for i in np.meshgrid(y0, x0, indexing='ij')]
+    ref_view = sliding_window_view(img1, (h, w))
+    search_view = sliding_window_view(img2, (h + 2 * sy, w + 2 * sx))
+
+    results = []
+    for start in range(0, ty.size, batch_size):
+        by = ty[start:start + batch_size]
+        bx = tx[start:start + batch_size]
+        ref = ref_view[by, bx]
+        search = search_view[by - sy, bx - sx]
+        field = _correlate_batch(ref, search, sy, sx, oversampling, nodata)
+        field[:, 0] += bx + w // 2 + 1
+        field[:, 2] += by + h // 2 + 1
+        results.append(field[~np.isnan(field).any(axis=1)])
+
+    if not results:
+        return np.empty((0, 8))
+    return np.vstack(results)
+
+
+def check_image_size(shape, pxsettings):
+    """
+    Raise a ValueError if an image of this shape cannot hold a single
+    reference chip with its search range (e.g., a small AOI).
+    """
+    min_y = pxsettings['refwindow_y'] + 2 * pxsettings['searchwindow_y']
+    min_x = pxsettings['refwindow_x'] + 2 * pxsettings['searchwindow_x']
+    if shape[0] < min_y or shape[1] < min_x:
+        raise ValueError('The images ({} x {} pixels) are smaller than the '
+                         'reference window plus the search range ({} x {} '
+                         'pixels). Use a larger AOI or smaller '
+                         'windows.'.format(shape[1], shape[0], min_x, min_y))
+
+
+def chip_rows(ny, pxsettings):
+    """
+    Upper-left rows of the reference chips in an image with ny rows.
+    """
+    h, sy = pxsettings['refwindow_y'], pxsettings['searchwindow_y']
+    return np.arange(sy, ny - h - sy + 1, pxsettings['skip_down'])
+
+
+def gaussian_highpass(data, sigma, truncate=1.0):
+    """
+    The same filter as CARST's SingleRaster.GaussianHighPass, on an array:
+    zeros (LS-8 nodata) become NaN, and the Gaussian low-pass is removed.
+    """
+    data = data.astype(float)
+    data[data == 0] = np.nan
+    return data - gaussian_filter(data, sigma, truncate=truncate)
+
+
+def ncc_offsets_tiled(img1, img2, pxsettings, workers=4, n_tiles=None,
+                      gaussian_hp_sigma=None, truncate=1.0, **kwargs):
+    """
+    ncc_offsets on a process pool. The image pair is put into shared memory
+    and split into row bands; each band holds whole rows of reference
+    chips plus the margins needed by the search range and by the high-pass
+    filter, so the merged result is the same as running on the whole image.
+
+    workers:           number of processes.
+    n_tiles:           number of row bands (default: 4 per process).
+    gaussian_hp_sigma: if given, gaussian_highpass is applied per band.
+    kwargs:            passed to ncc_offsets.
+    """
+    img1 = np.asarray(img1)
+    img2 = np.asarray(img2)
+    if img1.shape != img2.shape:
+        raise ValueError('The two images need to have the same size.')
+    check_image_size(img1.shape, pxsettings)
+    ny = img1.shape[0]
+    h, sy = pxsettings['refwindow_y'], pxsettings['searchwindow_y']
+    halo = 0
+    if gaussian_hp_sigma:
+        # kernel radius used by scipy.ndimage.gaussian_filter
+        halo = int(truncate * float(gaussian_hp_sigma) + 0.5)
+    if n_tiles is None:
+        n_tiles = 4 * workers
+    groups = [g for g in np.array_split(chip_rows(ny, pxsettings), n_tiles)
+              if g.size > 0]
+
+    shms = []
+    try:
+        names = []
+        for img in (img1, img2):
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(img.nbytes, 1))
+            shms.append(shm)
+            np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)[:] = img
+            names.append(shm.name)
+        tasks = []
+        for g in groups:
+            r0 = max(g[0] - sy - halo, 0)
+            r1 = min(g[-1] + h + sy + halo, ny)
+            tasks.append((names, img1.shape, img1.dtype.str, r0, r1, g - r0,
+                          pxsettings, gaussian_hp_sigma, truncate, kwargs))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            fields = list(pool.map(_track_tile, tasks))
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    if not fields:
+        return np.empty((0, 8))
+    return np.vstack(fields)
+
+
+def _track_tile(task):
+    names, shape, dtype, r0, r1, rows, pxsettings, sigma, truncate, \
+        kwargs = task
+    bands = []
+    for name in names:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            band = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[r0:r1]
+            if sigma:
+                band = gaussian_highpass(band, sigma, truncate=truncate)
+            else:
+                band = band.astype(float)
+            bands.append(band)
+        finally:
+            shm.close()
+    field = ncc_offsets(bands[0], bands[1], pxsettings, rows=rows, **kwargs)
+    field[:, 2] += r0
+    return field
+
+
+def _correlate_batch(ref, search, sy, sx, oversampling, nodata):
+    """
+    NCC of a batch of reference chips (B, h, w) over their search chips
+    (B, h + 2sy, w + 2sx). Returns (B, 8) rows in the ampcor layout with
+    zero cell numbers; invalid rows are NaN.
+    """
+    b, h, w = ref.shape
+    fshape = search.shape[1:]
+    valid = (np.isfinite(ref).all(axis=(1, 2)) &
+             np.isfinite(search).all(axis=(1, 2)))
+    for val in nodata:
+        valid &= ~(ref == val).any(axis=(1, 2))
+        valid &= ~(search == val).any(axis=(1, 2))
+    ref = np.where(valid[:, None, None], ref, 0.0)
+    search = np.where(valid[:, None, None], search, 0.0)
+
+    ref = ref - ref.mean(axis=(1, 2), keepdims=True)
+    ref_norm = np.sqrt((ref ** 2).sum(axis=(1, 2)))
+
+    # numerator: cross-correlation of the search chip with the zero-mean
+    # reference chip. The circular correlation does not wrap around for
+    # offsets within the search range.
+    numerator = np.fft.irfft2(np.fft.rfft2(search, fshape) *
+                              np.conj(np.fft.rfft2(ref, fshape)), fshape)
+    numerator = numerator[:, :2 * sy + 1, :2 * sx + 1]
+
+    # denominator: local sums of the search chip over each (h, w) window,
+    # from integral images.
+    s1 = _window_sums(search, h, w)
+    s2 = _window_sums(search ** 2, h, w)
+    search_var = np.maximum(s2 - s1 ** 2 / (h * w), 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ncc = numerator / (np.sqrt(search_var) *
+                           ref_norm[:, None, None])
+    ncc[~np.isfinite(ncc)] = -1.0
+
+    # integer peak
+    surface_w = 2 * sx + 1
+    k = ncc.reshape(b, -1).argmax(axis=1)
+    pu, pv = np.divmod(k, surface_w)
+    on_edge = (pu == 0) | (pu == 2 * sy) | (pv == 0) | (pv == 2 * sx)
+    valid &= ~on_edge & (ref_norm > 0)
+    cu = np.clip(pu, 1, 2 * sy - 1)
+    cv = np.clip(pv, 1, 2 * sx - 1)
+    idx = np.arange(b)
+
+    # subpixel peak by a parabola fit in each direction
+    c0 = ncc[idx, cu, cv]
+    cym, cyp = ncc[idx, cu - 1, cv], ncc[idx, cu + 1, cv]
+    cxm, cxp = ncc[idx, cu, cv - 1], ncc[idx, cu, cv + 1]
+    dyy = cym - 2 * c0 + cyp
+    dxx = cxm - 2 * c0 + cxp
+    dxy = (ncc[idx, cu + 1, cv + 1] - ncc[idx, cu + 1, cv - 1] -
+           ncc[idx, cu - 1, cv + 1] + ncc[idx, cu - 1, cv - 1]) / 4
+    valid &= (dyy < 0) & (dxx < 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        suby = np.clip((cym - cyp) / (2 * dyy), -0.5, 0.5)
+        subx = np.clip((cxm - cxp) / (2 * dxx), -0.5, 0.5)
+    suby = np.round(suby * oversampling) / oversampling
+    subx = np.round(subx * oversampling) / oversampling
+
+    # SNR and the offset covariance from the curvature of the peak
+    # rounding in the sums can push a near-perfect match slightly above 1,
+    # which would make 1 - peak (and the covariances) negative.
+    peak = np.minimum(c0, 1.0)
+    snr = peak / np.abs(ncc).mean(axis=(1, 2))
+    det = dxx * dyy - dxy ** 2
+    valid &= (det > 0) & (peak > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = (1.0 - peak) / (peak * h * w * det)
+        field = np.column_stack([np.zeros(b), pv - sx + subx,
+                                 np.zeros(b), pu - sy + suby,
+                                 snr, -dyy * scale, -dxx * scale,
+                                 dxy * scale])
+    field[~valid] = np.nan
+    return field
+
+
+def _window_sums(arr, h, w):
+    ii = np.zeros((arr.shape[0], arr.shape[1] + 1, arr.shape[2] + 1))
+    ii[:, 1:, 1:] = arr.cumsum(axis=1).cumsum(axis=2)
+    return ii[:, h:, w:] - ii[:, :-h, w:] - ii[:, h:, :-w] + ii[:, :-h, :-w]
+
+
+def ncc_task(imgpair, ini):
+    """
+    Run the NCC kernel on a pair of SingleRaster objects (same grid),
+    like carst.libft.ampcor_task does for ampcor.
+    The Gaussian high-pass filter (if ini.pxsettings['gaussian_hp']) is
+    applied here in memory, and the work is split over
+    ini.pxsettings['threads'] processes.
+    """
+    sigma = None
+    if ini.pxsettings['gaussian_hp']:
+        sigma = ini.pxsettings.get('gaussian_hp_sigma', 3.0)
+    img1 = imgpair[0].ReadAsArray()
+    img2 = imgpair[1].ReadAsArray()
+    workers = int(ini.pxsettings.get('threads', 1))
+    if workers > 1:
+        return ncc_offsets_tiled(img1, img2, ini.pxsettings, workers=workers,
+                                 gaussian_hp_sigma=sigma)
+    if sigma:
+        img1 = gaussian_highpass(img1, sigma)
+        img2 = gaussian_highpass(img2, sigma)
+    return ncc_offsets(img1, img2, ini.pxsettings)
+
+
+def writeout_ncc_task(field, ini):
+    """
+    Save the offsets in the same pickle (and text) format as
+    carst.libft.writeout_ampcor_task.
+    """
+    pickle.dump(field, open(ini.rawoutput['label_ampcor'] + '.p', 'wb'))
+    if ini.rawoutput['if_generate_ampofftxt']:
+        np.savetxt(ini.rawoutput['label_ampcor'] + '.txt', field,
+                   delimiter=" ",
+                   fmt='%5d %10.6f %5d %10.6f %10.6f %11.6f %11.6f %11.6f')
@@ -0,0 +1,201 @@
+# Post-processing of velocity fields (the output of
+# velofield.offsets_to_velocity): bedrock-based bias correction and noise
+# removal, configured by the [velocorrection] and [noiseremoval] sections
+# of param.ini. The same steps as CARST's featuretrack.py ('correctvelo'
+# and 'rmnoise'), done on arrays in memory instead of on GeoTIFF files.
+# The neighborhood filters also work on dask-backed (chunked) fields; the
+# chunks are processed with enough overlap to give the same result.
+
+import os
+import warnings
+import numpy as np
+import shapely
+import geopandas as gpd
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import gaussian_filter, label
+
+
+def outlier_mask(v, threshold=3, window=5):
+    """
+    Remove the points that differ from the median of their window-by-window
+    neighborhood by more than threshold robust standard deviations
+    (1.4826 * median absolute deviation) of that neighborhood.
+    """
+    r = window // 2
+    padded = np.pad(v, r, mode='constant', constant_values=np.nan)
+    windows = sliding_window_view(padded, (window, window))
+    with warnings.catch_warnings(), np.errstate(invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)    # all-NaN windows
+        median = np.nanmedian(windows, axis=(-2, -1))
+        mad = np.nanmedian(np.abs(windows - median[..., None, None]),
+                           axis=(-2, -1))
+        bad = np.abs(v - median) > threshold * 1.4826 * mad
+    return np.where(bad, np.nan, v)
+
+
+def gaussian_lp_mask(v, sigma=5, max_diff=1.0, truncate=4.0):
+    """
+    Remove the points that differ from a Gaussian low-pass of the field by
+    max_diff or more (RasterVelos.Gaussian_CutNoise). NaN points do not
+    contribute to the low-pass.
+    """
+    valid = np.isfinite(v)
+    vv = gaussian_filter(np.where(valid, v, 0.), sigma, truncate=truncate)
+    ww = gaussian_filter(valid.astype(float), sigma, truncate=truncate)
+    ww[ww == 0] = np.finfo(float).eps
+    return np.where(np.abs(v - vv / ww) >= max_diff, np.nan, v)
+
+
+def remove_small_clumps(v, min_size=101):
+    """
+    Remove the connected groups of valid points (4-connectivity) that have
+    fewer than min_size points (RasterVelos.SmallObjects_CutNoise).
+    """
+    labels, _ = label(np.isfinite(v))
+    sizes = np.bincount(labels.ravel())
+    small = sizes < min_size
+    small[0] = False
+    return np.where(small[labels], np.nan, v)
+
+
+def _apply(func, da, depth, **kwargs):
+    """
+    Apply a filter to a DataArray. A chunked array is filtered chunk by
+    chunk, with depth points of overlap.
+    """
+    if da.chunks is None:
+        return da.copy(data=func(da.values, **kwargs))
+    return da.copy(data=da.data.map_overlap(func, depth=depth,
+                                            boundary='none',
+                                            dtype=float, **kwargs))
+
+
+def bedrock_bias(ds, bedrock, snr_threshold=5, thres_sigma=3.0):
+    """
+    Velocity bias measured over stable ground (CARST's 'correctvelo' step).
+
+    bedrock:       a shapefile path or a GeoDataFrame of bedrock polygons.
+    snr_threshold: only points with SNR >= this are used.
+    thres_sigma:   (vx, vy) points further than this many standard
+                   deviations from the bulk are dropped. CARST uses a KDE
+                   contour for this; for normally distributed errors this is
+                   the same cut, computed as a Mahalanobis distance.
+    output:
+        a dict with the median (bias), standard deviation and count of
+        the bedrock points, or None if there are not enough of them.
+    """
+    if not isinstance(bedrock, gpd.GeoDataFrame):
+        bedrock = gpd.read_file(bedrock)
+    if ds.attrs.get('crs') and bedrock.crs is not None:
+        bedrock = bedrock.to_crs(ds.attrs['crs'])
+    xx, yy = np.meshgrid(ds.x.values, ds.y.values)
+    idx = shapely.contains_xy(shapely.union_all(bedrock.geometry.values),
+                              xx, yy)
+    idx &= ds['snr'].values >= snr_threshold
+    vx = ds['vx'].values[idx]
+    vy = ds['vy'].values[idx]
+    ok = np.isfinite(vx) & np.isfinite(vy)
+    vx, vy = vx[ok], vy[ok]
+    if vx.size < 3:
+        return None
+
+    xy = np.column_stack([vx, vy])
+    d = xy - np.median(xy, axis=0)
+    cov = np.cov(xy, rowvar=False)
+    dist2 = np.einsum('ij,jk,ik->i', d, np.linalg.pinv(cov), d)
+    signal = dist2 <= thres_sigma ** 2
+    vx, vy = vx[signal], vy[signal]
+    return {'bias_vx': float(np.median(vx)), 'bias_vy': float(np.median(vy)),
+            'std_vx': float(np.std(vx, ddof=1)),
+            'std_vy': float(np.std(vy, ddof=1)),
+            'n_bedrock': int(vx.size)}
+
+
+def correct_bias(ds, stats):
+    """
+    Remove the bedrock bias from vx and vy, and add its standard deviation
+    to errx and erry (RasterVelos.VeloCorrection).
+    """
+    ds = ds.copy()
+    ds['vx'] = ds['vx'] - stats['bias_vx']
+    ds['vy'] = ds['vy'] - stats['bias_vy']
+    ds['v'] = np.hypot(ds['vx'], ds['vy'])
+    ds['errx'] = ds['errx'] + stats['std_vx']
+    ds['erry'] = ds['erry'] + stats['std_vy']
+    ds.attrs.update(stats)
+    return ds
+
+
+def _number(value, number_type):
+    """
+    A parameter as int or float; None for None or an empty string.
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    return number_type(float(value))
+
+
+def postprocess(ds, ini=None, bedrock=None, snr=5, outlier_sigma_threshold=3,
+                gaussian_lp_mask_sigma=5, min_clump_size=101,
+                refvelo_outlier_sigma=3.0):
+    """
+    Bias correction and noise removal of a velocity field, in the order of
+    CARST's featuretrack.py. The parameters are read from ini.velocorrection
+    and ini.noiseremoval if they are there; otherwise the keyword values
+    are used. Steps with a parameter of None (or 0) are skipped.
+
+    1. bedrock bias correction (bedrock: a shapefile path or GeoDataFrame)
+    2. SNR masking
+    3. sigma outlier rejection
+    4. Gaussian low-pass masking
+    5. clump removal
+    Points removed from the speed v are removed from all of the variables
+    (RasterVelos.MaskAllRasters).
+    """
+    if ini is not None:
+        noiseremoval = getattr(ini, 'noiseremoval', {})
+        velocorrection = getattr(ini, 'velocorrection', {})
+        bedrock = velocorrection.get('bedrock', bedrock)
+        refvelo_outlier_sigma = velocorrection.get('refvelo_outlier_sigma',
+                                                   refvelo_outlier_sigma)
+        snr = noiseremoval.get('snr', snr)
+        outlier_sigma_threshold = noiseremoval.get('outlier_sigma_threshold',
+                                                   outlier_sigma_threshold)
+        gaussian_lp_mask_sigma = noiseremoval.get('gaussian_lp_mask_sigma',
+                                                  gaussian_lp_mask_sigma)
+        min_clump_size = noiseremoval.get('min_clump_size', min_clump_size)
+    # a ConfParams read from param.ini holds strings
+    snr = _number(snr, float)
+    outlier_sigma_threshold = _number(outlier_sigma_threshold, float)
+    gaussian_lp_mask_sigma = _number(gaussian_lp_mask_sigma, float)
+    min_clump_size = _number(min_clump_size, int)
+    refvelo_outlier_sigma = _number(refvelo_outlier_sigma, float) or 3.0
+    if isinstance(bedrock, str) and not bedrock.strip():
+        bedrock = None
+
+    if isinstance(bedrock, str) and not os.path.exists(bedrock):
+        print('Bedrock file not found: ' + bedrock
+              + '. Skip the velocity correction.')
+    elif bedrock is not None and len(bedrock) > 0:
+        stats = bedrock_bias(ds, bedrock, snr_threshold=snr or 0,
+                             thres_sigma=refvelo_outlier_sigma)
+        if stats is None:
+            print('Not enough bedrock points. Skip the velocity correction.')
+        else:
+            ds = correct_bias(ds, stats)
+
+    v = ds['v']
+    if snr:
+        v = v.where(ds['snr'] > snr)    # RasterVelos.SNR_CutNoise
+    if outlier_sigma_threshold:
+        v = _apply(outlier_mask, v, depth=2,
+                   threshold=outlier_sigma_threshold, window=5)
+    if gaussian_lp_mask_sigma:
+        v = _apply(gaussian_lp_mask, v,
+                   depth=int(4.0 * gaussian_lp_mask_sigma + 0.5),
+                   sigma=gaussian_lp_mask_sigma)
+    if min_clump_size:
+        # a clump smaller than min_size is never wider than min_size points
+        v = _apply(remove_small_clumps, v, depth=int(min_clump_size),
+                   min_size=int(min_clump_size))
+    return ds.where(v.notnull())
@@ -0,0 +1,212 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import numpy as np
+import rasterio
+from rasterio.warp import transform_bounds
+from carst import SingleRaster
+from lruindex import LRUIndex
+
+
+def unify_params(raster, output_dir='.'):
+    """
+    Params for SingleRaster.Unify that warp another raster onto the grid of
+    raster.
+    """
+    te = raster.GetExtent()
+    tr = (raster.GetXRes(), -raster.GetYRes())
+    t_srs = raster.GetProj4()
+    return {'output_dir': output_dir, 't_srs': t_srs,
+            'tr': '{} {}'.format(*tr),
+            'te': '{} {} {} {}'.format(te[0], te[3], te[2], te[1])}
+
+
+def overlap_params(urls, aoi=None, resolution=None, output_dir='.'):
+    """
+    Params for SingleRaster.Unify that cover only the area shared by all of
+    the scenes in urls (and by an AOI), on the pixel grid of the first
+    scene. Only the headers of the scenes are read. Warping onto this grid
+    then fetches just the overlapping blocks of a remote COG.
+
+    aoi:        (min_lon, min_lat, max_lon, max_lat), or a shapely geometry
+                in lon/lat. Only its bounding box is used here; the chips
+                outside of a geometry are dropped after the tracking (see
+                velofield.clip_field).
+    resolution: pixel size of the target grid (default: the pixel size of
+                the first scene). With a coarser one, GDAL reads the
+                overviews of a COG instead of the full resolution data.
+    """
+    with rasterio.open(urls[0]) as src:
+        crs = src.crs
+        transform = src.transform
+        xmin, ymin, xmax, ymax = src.bounds
+    for url in urls[1:]:
+        with rasterio.open(url) as src:
+            bounds = transform_bounds(src.crs, crs, *src.bounds,
+                                      densify_pts=21)
+        xmin, ymin = max(xmin, bounds[0]), max(ymin, bounds[1])
+        xmax, ymax = min(xmax, bounds[2]), min(ymax, bounds[3])
+    if aoi is not None:
+        if hasattr(aoi, 'bounds'):
+            aoi = aoi.bounds
+        bounds = transform_bounds('EPSG:4326', crs, *aoi, densify_pts=21)
+        xmin, ymin = max(xmin, bounds[0]), max(ymin, bounds[1])
+        xmax, ymax = min(xmax, bounds[2]), min(ymax, bounds[3])
+    if xmin >= xmax or ymin >= ymax:
+        raise ValueError('The scenes (and the AOI) do not overlap.')
+
+    # snap to the pixel grid of the first scene
+    x0, y0 = transform.c, transform.f
+    xres, yres = transform.a, -transform.e
+    xmin = x0 + np.floor((xmin - x0) / xres) * xres
+    xmax = x0 + np.ceil((xmax - x0) / xres) * xres
+    ymax = y0 - np.floor((y0 - ymax) / yres) * yres
+    ymin = y0 - np.ceil((y0 - ymin) / yres) * yres
+    if resolution is not None:
+        xres = yres = resolution
+    return {'output_dir': output_dir, 't_srs': crs.to_wkt(),
+            'tr': '{} {}'.format(xres, yres),
+            'te': '{} {} {} {}'.format(xmin, ymin, xmax, ymax)}
+
+
+class PreprocessCache:
+    """
+    A content-addressed disk cache of preprocessed scenes for feature
+    tracking: a scene warped onto a target grid (SingleRaster.Unify),
+    optionally high-pass filtered (SingleRaster.GaussianHighPass) and with
+    the .vrt file that SingleRaster.AmpcorPrep needs.
+
+    An entry is keyed by the source URL, the band, the target grid
+    (t_srs / tr / te) and the filter parameters, and is stored in
+    cache_dir/<key>/. The entries are indexed in cache_dir/index.sqlite;
+    least recently used entries are removed beyond max_bytes.
+    The cache can be shared by threads and processes.
+    """
+
+    def __init__(self, cache_dir='prep_cache', max_bytes=20 * 1024 ** 3):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.fname = os.path.join(cache_dir, 'index.sqlite')
+        self.index = LRUIndex(self.fname, 'scenes', column='fpath',
+                              max_bytes=max_bytes, timeout=60)
+
+    @staticmethod
+    def make_key(url, band=None, grid=None, gaussian_hp_sigma=None):
+        """
+        grid: the t_srs / tr / te params of SingleRaster.Unify.
+        """
+        if band is None:
+            # LS8 file names end with _<band>.TIF
+            band = os.path.basename(url).rsplit('.', 1)[0].split('_')[-1]
+        params = {'url': url, 'band': band,
+                  'gaussian_hp_sigma': gaussian_hp_sigma}
+        if grid is not None:
+            params.update({k: grid[k] for k in ('t_srs', 'tr', 'te')})
+        params = json.dumps({str(k): str(v) for k, v in params.items()},
+                            sort_keys=True)
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Return the path of the cached raster of a key, or None.
+        """
+        record = self.index.get(key)
+        if record is None:
+            return None
+        if not os.path.exists(record[0]):
+            self.index.delete(key)
+            return None
+        return record[0]
+
+    def put(self, key, fpath, protect=()):
+        """
+        Record an entry whose files are all in cache_dir/<key>/.
+        protect: keys that are not evicted to make room for it.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                   for f in os.listdir(entry_dir))
+        for evicted, _ in self.index.put(key, fpath, size, protect=protect):
+            shutil.rmtree(os.path.join(self.cache_dir, evicted),
+                          ignore_errors=True)
+
+    def prepare(self, url, date=None, grid=None, band=None,
+                gaussian_hp_sigma=None, ampcor_prep=False, protect=()):
+        """
+        Return a SingleRaster of the preprocessed scene, from the cache if
+        possible.
+
+        grid:              params for SingleRaster.Unify (see
+                           overlap_params). The scene is always
+                           copied into the cache, on its own grid if None.
+        gaussian_hp_sigma: apply SingleRaster.GaussianHighPass.
+        ampcor_prep:       call SingleRaster.AmpcorPrep (needs ISCE). Its
+                           .vrt file is kept in the cache; the ISCE image
+                           pointer itself is created each time.
+        protect:           keys of other entries in use (e.g., the other
+                           scene of a pair), which are not evicted to
+                           make room for this one.
+        """
+        key = self.make_key(url, band=band, grid=grid,
+                            gaussian_hp_sigma=gaussian_hp_sigma)
+        fpath = self.get(key)
+        if fpath is None:
+            fpath = self._build(key, url, grid, gaussian_hp_sigma, protect)
+        raster = SingleRaster(fpath, date=date)
+        if ampcor_prep:
+            raster.AmpcorPrep()
+            # update the size with the .vrt file
+            self.put(key, fpath, protect=protect)
+        return raster
+
+    def prepare_pair(self, urls, dates=(None, None), grid=None, band=None,
+                     gaussian_hp_sigma=None, ampcor_prep=False):
+        """
+        prepare() both scenes of an image pair. Neither of the two entries
+        is evicted while the other one is prepared.
+        """
+        keys = [self.make_key(url, band=band, grid=grid,
+                              gaussian_hp_sigma=gaussian_hp_sigma)
+                for url in urls]
+        return [self.prepare(url, date, grid=grid, band=band,
+                             gaussian_hp_sigma=gaussian_hp_sigma,
+                             ampcor_prep=ampcor_prep, protect=keys)
+                for url, date in zip(urls, dates)]
+
+    def _build(self, key, url, grid, gaussian_hp_sigma, protect=()):
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = entry_dir + '.tmp-{}-{}'.format(os.getpid(),
+                                                threading.get_ident())
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            raster = SingleRaster(url)
+            if grid is None:
+                grid = unify_params(raster)
+            params = dict(grid)
+            params['output_dir'] = tmp_dir
+            raster.Unify(params)
+            if gaussian_hp_sigma:
+                warped_path = raster.fpath
+                raster.GaussianHighPass(sigma=gaussian_hp_sigma)
+                os.remove(warped_path)
+            fname = os.path.basename(raster.fpath)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # built by another worker in the meantime
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        fpath = os.path.join(entry_dir, fname)
+        self.put(key, fpath, protect=protect)
+        return fpath
+
+    def clear(self):
+        for key, _ in self.index.clear():
+            shutil.rmtree(os.path.join(self.cache_dir, key),
+                          ignore_errors=True)
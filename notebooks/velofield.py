@@ -0,0 +1,184 @@
+# In-memory offset-to-velocity pipeline.
+# The same conversion as CARST's AmpcoroffFile (CheckData, FillwithNAN,
+# Ampcoroff2Velo and XYV2Raster), without the .p file round trip: the
+# offsets stay in NumPy arrays and the velocity field is an xarray Dataset
+# on the grid of the reference chips. Since the chips are on a regular
+# grid, they are put in place by indexing instead of the griddata step of
+# Velo2XYV.
+
+import os
+import numpy as np
+import shapely
+import xarray as xr
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from pyproj import Transformer
+
+# output file suffixes of CARST's XYV2Raster
+GEOTIFF_SUFFIXES = {'v': 'mag', 'vx': 'vx', 'vy': 'vy', 'snr': 'snr',
+                    'errx': 'errx', 'erry': 'erry'}
+
+
+def ampcor_field(task_result):
+    """
+    The N-by-8 offset array of carst.libft.ampcor_task, as
+    writeout_ampcor_task would save it (but without saving it).
+    """
+    field_list = [np.array(i.getOffsetField().unpackOffsets())
+                  for i in task_result]
+    field_list = [i for i in field_list if i.size > 0]
+    field = np.vstack(field_list)
+    cov = np.stack([np.hstack([np.array(i.getCov1()) for i in task_result]),
+                    np.hstack([np.array(i.getCov2()) for i in task_result]),
+                    np.hstack([np.array(i.getCov3()) for i in task_result])])
+    return np.concatenate([field, cov.T], axis=1)
+
+
+def clip_field(field, geotransform, projection, aoi):
+    """
+    Drop the chips of an offset array (the ampcor layout) whose centers are
+    outside aoi, a shapely geometry in lon/lat. The chip centers are
+    located as in offsets_to_velocity.
+    """
+    field = np.asarray(field, dtype=float)
+    ulx, xres, _, uly, _, yres = geotransform
+    transformer = Transformer.from_crs('EPSG:4326', projection, always_xy=True)
+    # densify the edges, so that they follow the lon/lat lines
+    aoi_xy = shapely.transform(shapely.segmentize(aoi, 0.01),
+                               lambda c: np.column_stack(transformer.transform(
+                                   c[:, 0], c[:, 1])))
+    inside = shapely.contains_xy(aoi_xy, ulx + (field[:, 0] - 1) * xres,
+                                 uly + (field[:, 2] - 1) * yres)
+    return field[inside]
+
+
+def offsets_to_velocity(field, geotransform, days, skip_across,
+                        projection=None, max_offset=1000):
+    """
+    Convert an offset array (the ampcor layout) into a velocity field.
+
+    geotransform: the GDAL geotransform of the reference image.
+    days:         time span between the two images.
+    skip_across:  spacing of the reference chips along x (in pixels).
+    projection:   WKT of the reference image, kept in ds.attrs['crs'].
+    max_offset:   offsets larger than this (in pixels) are dropped, like
+                  AmpcoroffFile.CheckData.
+    output:
+        an xarray Dataset with dimensions (y, x) at the chip centers and
+        the variables vx, vy, v (m/day), snr, errx and erry (as in
+        AmpcoroffFile.Ampcoroff2Velo). Missing chips are NaN.
+    """
+    field = np.asarray(field, dtype=float)
+    field = field[(np.abs(field[:, [1, 3]]) <= max_offset).all(axis=1)]
+    ulx, xres, _, uly, _, yres = geotransform
+
+    # the complete grid of chips (AmpcoroffFile.FillwithNAN)
+    if field.shape[0] == 0:
+        x_cells = np.empty(0)
+        y_cells = np.empty(0)
+    else:
+        x_cells = np.arange(field[:, 0].min(),
+                            field[:, 0].max() + skip_across, skip_across)
+        y_cells = np.unique(field[:, 2])
+    ix = np.rint((field[:, 0] - x_cells[:1]) / skip_across).astype(int)
+    iy = np.searchsorted(y_cells, field[:, 2])
+
+    def grid(values):
+        out = np.full((y_cells.size, x_cells.size), np.nan)
+        out[iy, ix] = values
+        return out
+
+    vx = grid(field[:, 1] * abs(xres) / days)
+    vy = grid(-field[:, 3] * abs(yres) / days)   # UL-LR system to Cartesian
+    dims = ('y', 'x')
+    ds = xr.Dataset({'vx': (dims, vx),
+                     'vy': (dims, vy),
+                     'v': (dims, np.hypot(vx, vy)),
+                     'snr': (dims, grid(field[:, 4])),
+                     'errx': (dims, grid(np.sqrt(field[:, 5]) / days)),
+                     'erry': (dims, grid(np.sqrt(field[:, 6]) / days))},
+                    coords={'x': ulx + (x_cells - 1) * xres,
+                            'y': uly + (y_cells - 1) * yres})
+    ds.attrs['crs'] = projection
+    return ds
+
+
+def _geotransform(ds):
+    if ds.x.size == 0 or ds.y.size == 0:
+        raise ValueError('The velocity field is empty (no chip was '
+                         'tracked); nothing to write.')
+    x = ds.x.values
+    y = ds.y.values
+    xres = x[1] - x[0] if x.size > 1 else 1.
+    yres = y[1] - y[0] if y.size > 1 else -1.
+    # the same geotransform as CARST's XYZArray2Raster
+    return Affine(xres, 0, x[0], 0, yres, y[0])
+
+
+def write_geotiff(ds, prefix, variables=('v',), nodata=-9999.0):
+    """
+    Write variables of a velocity field to prefix + '_<suffix>.tif', with
+    the file names of CARST's XYV2Raster (v -> prefix_mag.tif).
+    output:
+        a list of the file paths.
+    """
+    transform = _geotransform(ds)
+    paths = []
+    for var in variables:
+        fpath = prefix + '_' + GEOTIFF_SUFFIXES.get(var, var) + '.tif'
+        with rasterio.open(fpath, 'w', driver='GTiff', width=ds.x.size,
+                           height=ds.y.size, count=1, dtype='float32',
+                           crs=ds.attrs.get('crs'), transform=transform,
+                           nodata=nodata) as dst:
+            dst.write(ds[var].fillna(nodata).values.astype('float32'), 1)
+        paths.append(fpath)
+    return paths
+
+
+def write_cog(ds, fpath, variables=('v', 'vx', 'vy', 'snr'), blocksize=256,
+              compress='deflate', overviews=(2, 4, 8, 16), nodata=-9999.0):
+    """
+    Write variables of a velocity field as the bands of one Cloud-Optimized
+    GeoTIFF: tiled, compressed, and with overviews. The bands are named
+    after CARST's output files (v -> 'mag').
+
+    The data are written block by block, so a dask-backed field is computed
+    one block at a time. They go into a temporary tiled GeoTIFF first; the
+    overviews are built there and copied with it into the COG layout.
+    output:
+        the COG, opened with rasterio.
+    """
+    transform = _geotransform(ds)    # raises a ValueError if ds is empty
+    profile = {'driver': 'GTiff', 'width': ds.x.size, 'height': ds.y.size,
+               'count': len(variables), 'dtype': 'float32',
+               'crs': ds.attrs.get('crs'), 'transform': transform,
+               'nodata': nodata, 'tiled': True, 'blockxsize': blocksize,
+               'blockysize': blocksize, 'compress': compress}
+    if compress in ('deflate', 'lzw', 'zstd'):
+        profile['predictor'] = 3    # floating point predictor
+    tmp_path = fpath + '.tmp.tif'
+    try:
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for band, var in enumerate(variables, start=1):
+                dst.set_band_description(band,
+                                         GEOTIFF_SUFFIXES.get(var, var))
+            for _, window in dst.block_windows(1):
+                rows, cols = window.toslices()
+                block = [ds[var][rows, cols].fillna(nodata).values
+                         for var in variables]
+                dst.write(np.stack(block).astype('float32'), window=window)
+            levels = [i for i in overviews
+                      if min(ds.x.size, ds.y.size) // i >= 1]
+            if levels:
+                dst.build_overviews(levels, Resampling.average)
+        rasterio.shutil.copy(tmp_path, fpath, driver='GTiff',
+                             copy_src_overviews=True, tiled=True,
+                             blockxsize=blocksize, blockysize=blocksize,
+                             compress=compress,
+                             predictor=profile.get('predictor', 1))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return rasterio.open(fpath)
@@ -0,0 +1,426 @@
+import os
+import fcntl
+from contextlib import contextmanager
+import fsspec
+import netCDF4
+import xarray as xr
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import LineString, Polygon
+from pyproj import Transformer
+from concurrent.futures import ThreadPoolExecutor
+from geostacks import SpatialIndexITSLIVE
+
+
+def granule_crs(ds):
+    """
+    Return the CRS of an ITS_LIVE granule (e.g., 'EPSG:3413'),
+    read from the attributes of its 'mapping' variable.
+    """
+    attrs = ds['mapping'].attrs
+    if 'spatial_epsg' in attrs:
+        return 'EPSG:{}'.format(int(attrs['spatial_epsg']))
+    return attrs['crs_wkt']
+
+
+def lonlat_to_xy(lon, lat, crs):
+    transformer = Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+    return transformer.transform(lon, lat)
+
+
+def lonlat_bounds_to_xy(bounds, crs):
+    """
+    Transform (min_lon, min_lat, max_lon, max_lat) into
+    (xmin, ymin, xmax, ymax) in crs. The edges are densified, so that the
+    result covers the whole lon/lat box.
+    """
+    transformer = Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+    return transformer.transform_bounds(*bounds, densify_pts=21)
+
+
+def subset_xy(ds, xy_bounds):
+    """
+    Cut a granule to (xmin, ymin, xmax, ymax). The y axis of ITS_LIVE
+    granules usually goes from north to south, but both orders work.
+    """
+    xmin, ymin, xmax, ymax = xy_bounds
+    if ds.y.size > 1 and ds.y.values[0] > ds.y.values[-1]:
+        yslice = slice(ymax, ymin)
+    else:
+        yslice = slice(ymin, ymax)
+    return ds.sel(x=slice(xmin, xmax), y=yslice)
+
+
+def open_granule(url, point=None, buffer=10000., bbox=None,
+                 variables=('v', 'vx', 'vy'), chunks={}, load=False,
+                 block_size=2 ** 20):
+    """
+    Open an ITS_LIVE granule (a URL or a local path) lazily and cut it to
+    an area of interest before any data variable is read.
+
+    point:     [lon, lat]; the granule is cut to +/- buffer (in meters)
+               around it.
+    bbox:      (min_lon, min_lat, max_lon, max_lat); used if point is None.
+    variables: data variables to keep.
+    chunks:    passed to xr.open_dataset; {} gives dask arrays with the
+               chunks of the file.
+    load:      read the subset into memory and close the remote file.
+               Otherwise the file stays open until the dataset is closed.
+    output:
+        an xarray Dataset, with the granule CRS in ds.attrs['crs'].
+    """
+    if url.startswith('http://') or url.startswith('https://'):
+        # block cache: only the HDF5 blocks that we touch are fetched
+        fobj = fsspec.open(url, mode='rb', block_size=block_size,
+                           cache_type='blockcache').open()
+    else:
+        fobj = fsspec.open(url, mode='rb').open()
+    ds = xr.open_dataset(fobj, engine='h5netcdf', chunks=chunks)
+    close_file = ds.close    # the h5netcdf file; the subsets below lose it
+
+    def close():
+        close_file()
+        fobj.close()
+
+    crs = granule_crs(ds)
+    ds = ds[list(variables)]
+
+    if point is not None:
+        x, y = lonlat_to_xy(point[0], point[1], crs)
+        ds = subset_xy(ds, (x - buffer, y - buffer, x + buffer, y + buffer))
+    elif bbox is not None:
+        ds = subset_xy(ds, lonlat_bounds_to_xy(bbox, crs))
+    ds.attrs['crs'] = crs
+
+    if load:
+        ds = ds.load()
+        close()
+    else:
+        ds.set_close(close)
+    return ds
+
+
+class VelocityStack:
+    """
+    A time series of ITS_LIVE velocity granules, aligned onto a common grid
+    and a time axis of the mid-dates of the image pairs.
+    self.cube is a chunked (dask-backed) xarray Dataset with dimensions
+    (mid_date, y, x), and with start_date, end_date, pair_days and url as
+    coordinates along mid_date.
+    The granules stay open while the cube is used; close() (or a with
+    block) closes them.
+    """
+
+    def __init__(self, cube=None):
+
+        self.cube = cube
+        self.crs = None if cube is None else cube.attrs['crs']
+        self.sources = []    # the opened granules behind self.cube
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Close the granules. The cube cannot be read afterwards, unless it
+        has been loaded into memory.
+        """
+        for ds in self.sources:
+            ds.close()
+        self.sources = []
+
+    def build(self, urls, point=None, buffer=10000., bbox=None,
+              variables=('v', 'vx', 'vy'), chunks={'mid_date': 16},
+              max_workers=8):
+        """
+        Open all of the granules lazily and stack them.
+
+        urls:  a list of granule urls (or local paths)
+        point, buffer, bbox, variables: see open_granule. The common grid
+               covers this area; without point or bbox, it covers all of
+               the granules.
+        Granules in a CRS other than the first one are skipped.
+        """
+        def open_or_report(url):
+            try:
+                return open_granule(url, point=point, buffer=buffer,
+                                    bbox=bbox, variables=variables)
+            except (IOError, OSError, KeyError, ValueError) as e:
+                print('Cannot open ' + url + ' (' + str(e) + ')')
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            datasets = list(pool.map(open_or_report, urls))
+
+        keep = [i for i, ds in enumerate(datasets) if ds is not None]
+        if not keep:
+            print('No granules to stack.')
+            return self
+        self.crs = datasets[keep[0]].attrs['crs']
+        for i in keep:
+            if datasets[i].attrs['crs'] != self.crs:
+                print('Skip ' + urls[i] + ': not in ' + self.crs)
+        keep = [i for i in keep if datasets[i].attrs['crs'] == self.crs]
+        for i, ds in enumerate(datasets):
+            if ds is not None and i not in keep:
+                ds.close()
+        self.close()    # the granules of an earlier build
+        self.sources = [datasets[i] for i in keep]
+
+        x, y = self._common_grid([datasets[i] for i in keep])
+        res = abs(x[1] - x[0]) if x.size > 1 else np.inf
+        aligned = [datasets[i].reindex(x=x, y=y, method='nearest',
+                                       tolerance=res / 2) for i in keep]
+        cube = xr.concat(aligned, dim='mid_date', join='override',
+                         combine_attrs='override').chunk(chunks)
+        table = SpatialIndexITSLIVE.granule_table([{'url': urls[i]}
+                                                   for i in keep])
+        cube = cube.assign_coords(
+            mid_date=table['mid_date'].values,
+            start_date=('mid_date', table['start_date'].values),
+            end_date=('mid_date', table['end_date'].values),
+            pair_days=('mid_date', table['pair_days'].values),
+            url=('mid_date', table['url'].values))
+        cube = cube.sortby('mid_date')
+        cube.attrs = {'crs': self.crs}
+        self.cube = cube
+        return self
+
+    @staticmethod
+    def _common_grid(datasets):
+        """
+        The grid of the first granule, extended to cover all of them.
+        ITS_LIVE granules of the same CRS share the same grid spacing.
+        """
+        x0 = datasets[0].x.values
+        y0 = datasets[0].y.values
+        if x0.size < 2 or y0.size < 2:
+            return x0, y0
+        dx = x0[1] - x0[0]
+        dy = y0[1] - y0[0]
+        xmin = min(ds.x.values.min() for ds in datasets if ds.x.size)
+        xmax = max(ds.x.values.max() for ds in datasets if ds.x.size)
+        ymin = min(ds.y.values.min() for ds in datasets if ds.y.size)
+        ymax = max(ds.y.values.max() for ds in datasets if ds.y.size)
+        x = x0[0] + dx * np.arange(np.floor((xmin - x0[0]) / abs(dx)),
+                                   np.floor((xmax - x0[0]) / abs(dx)) + 1)
+        if dy < 0:
+            y = y0[0] + dy * np.arange(np.floor((y0[0] - ymax) / abs(dy)),
+                                       np.floor((y0[0] - ymin) / abs(dy)) + 1)
+        else:
+            y = y0[0] + dy * np.arange(np.floor((ymin - y0[0]) / dy),
+                                       np.floor((ymax - y0[0]) / dy) + 1)
+        return x, y
+
+    def point_series(self, lon, lat):
+        """
+        Time series at the grid cell nearest to a lon/lat point.
+        """
+        x, y = lonlat_to_xy(lon, lat, self.crs)
+        return self.cube.sel(x=x, y=y, method='nearest')
+
+    def profile_series(self, line, spacing=None):
+        """
+        Time series along a flowline, sampled every spacing meters
+        (default: the grid spacing) at the nearest grid cells.
+
+        line: a list of [lon, lat] vertices.
+        output: a Dataset with dimensions (mid_date, distance).
+        """
+        lon, lat = np.asarray(line, dtype=float).T
+        line_xy = LineString(np.column_stack(lonlat_to_xy(lon, lat,
+                                                          self.crs)))
+        if spacing is None:
+            spacing = abs(float(self.cube.x[1] - self.cube.x[0]))
+        distance = np.arange(0, line_xy.length + spacing / 2, spacing)
+        pts = shapely.get_coordinates(shapely.line_interpolate_point(
+            line_xy, distance))
+        return self.cube.sel(x=xr.DataArray(pts[:, 0], dims='distance'),
+                             y=xr.DataArray(pts[:, 1], dims='distance'),
+                             method='nearest').assign_coords(
+                                 distance=distance)
+
+    def polygon_mean_series(self, polygon):
+        """
+        Time series of the mean values inside a polygon.
+
+        polygon: a list of [lon, lat] vertices, or a shapely Polygon in
+                 lon/lat.
+        """
+        if not hasattr(polygon, 'exterior'):
+            polygon = Polygon(polygon)
+        transformer = Transformer.from_crs('EPSG:4326', self.crs,
+                                           always_xy=True)
+        polygon_xy = shapely.transform(
+            polygon, lambda c: np.column_stack(transformer.transform(
+                c[:, 0], c[:, 1])))
+        xx, yy = np.meshgrid(self.cube.x.values, self.cube.y.values)
+        mask = xr.DataArray(shapely.contains_xy(polygon_xy, xx, yy),
+                            dims=('y', 'x'))
+        return self.cube.where(mask).mean(dim=('y', 'x'))
+
+
+class VelocityStore:
+    """
+    An appendable time series of velocity fields on disk, e.g., one for each
+    Landsat path/row: a chunked Zarr store, or a NetCDF file if path ends
+    with .nc. It has the layout of VelocityStack.cube: dimensions
+    (mid_date, y, x), with start_date, end_date and pair_days along
+    mid_date, so VelocityStack(store.open()) gives the point, profile and
+    polygon series of the stored pairs.
+
+    The grid is fixed by the first field appended: its origin and spacing,
+    extended or cut to bounds (xmin, ymin, xmax, ymax in the CRS of the
+    fields) if given. Later fields are put onto it at the nearest grid
+    cells. Appends are serialized with a lock file (path + '.lock'), so
+    that one store can be shared by many processes.
+    """
+
+    # time coordinates are stored as floats, so that mid-dates at noon can
+    # be appended to a store that started with a mid-date at midnight
+    TIME_ENCODING = {'units': 'hours since 1970-01-01', 'dtype': 'float64'}
+
+    def __init__(self, path, bounds=None, variables=('v', 'vx', 'vy', 'snr'),
+                 chunksize=256):
+
+        self.path = path
+        self.bounds = bounds
+        self.variables = variables
+        self.chunksize = chunksize
+        self.netcdf = path.endswith('.nc')
+
+    @staticmethod
+    def pathrow_path(folder, path, row, netcdf=False):
+        """
+        The store of a WRS-2 path/row in folder, e.g., velocity_009011.zarr.
+        """
+        ext = '.nc' if netcdf else '.zarr'
+        return os.path.join(folder, 'velocity_{:03d}{:03d}'.format(
+            int(path), int(row)) + ext)
+
+    @contextmanager
+    def _lock(self, mode=fcntl.LOCK_EX):
+        parent = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(parent, exist_ok=True)
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _open(self, chunks=None):
+        if self.netcdf:
+            return xr.open_dataset(self.path, engine='netcdf4', chunks=chunks)
+        return xr.open_zarr(self.path, chunks=chunks)
+
+    def open(self, chunks={}):
+        """
+        The whole time series as a lazy Dataset, sorted by mid_date.
+        """
+        with self._lock(fcntl.LOCK_SH):
+            ds = self._open(chunks=chunks)
+        return ds.sortby('mid_date')
+
+    def has_pair(self, start_date, end_date):
+        """
+        True if the pair is already in the store.
+        """
+        with self._lock(fcntl.LOCK_SH):
+            return self._has_pair(pd.Timestamp(start_date),
+                                  pd.Timestamp(end_date))
+
+    def _has_pair(self, start_date, end_date):
+        if not os.path.exists(self.path):
+            return False
+        with self._open() as store:
+            return bool(((store['start_date'].values == start_date)
+                         & (store['end_date'].values == end_date)).any())
+
+    def append(self, ds, start_date, end_date):
+        """
+        Append a velocity field (e.g., the output of
+        velofield.offsets_to_velocity) of the pair start_date - end_date.
+        A pair that is already in the store is not added again.
+        output:
+            True if the field is appended.
+        """
+        start_date = pd.Timestamp(start_date)
+        end_date = pd.Timestamp(end_date)
+        with self._lock():
+            if self._has_pair(start_date, end_date):
+                return False
+            if os.path.exists(self.path):
+                with self._open() as store:
+                    x = store.x.values
+                    y = store.y.values
+                entry = self._entry(ds, x, y, start_date, end_date)
+                self._append(entry)
+            else:
+                x = self._axis(ds.x.values, 0)
+                y = self._axis(ds.y.values, 1)
+                entry = self._entry(ds, x, y, start_date, end_date)
+                self._create(entry)
+        return True
+
+    def _axis(self, v, i):
+        """
+        The grid axis of v, extended or cut to self.bounds.
+        """
+        if self.bounds is None or v.size < 2:
+            return v
+        d = v[1] - v[0]
+        lo, hi = self.bounds[i], self.bounds[i + 2]
+        k = sorted([(lo - v[0]) / d, (hi - v[0]) / d])
+        return v[0] + d * np.arange(np.ceil(k[0] - 1e-9),
+                                    np.floor(k[1] + 1e-9) + 1)
+
+    def _entry(self, ds, x, y, start_date, end_date):
+        res = abs(x[1] - x[0]) if x.size > 1 else np.inf
+        entry = ds[list(self.variables)].reindex(
+            x=x, y=y, method='nearest', tolerance=res / 2).astype('float32')
+        entry = entry.expand_dims(
+            mid_date=[start_date + (end_date - start_date) / 2])
+        entry = entry.assign_coords(
+            start_date=('mid_date', [start_date]),
+            end_date=('mid_date', [end_date]),
+            pair_days=('mid_date', [(end_date - start_date).days]))
+        entry.attrs = {}
+        if ds.attrs.get('crs'):
+            entry.attrs['crs'] = ds.attrs['crs']
+        return entry
+
+    def _create(self, entry):
+        encoding = {name: dict(self.TIME_ENCODING)
+                    for name in ('mid_date', 'start_date', 'end_date')}
+        chunks = (1, min(self.chunksize, entry.y.size),
+                  min(self.chunksize, entry.x.size))
+        for var in self.variables:
+            if self.netcdf:
+                encoding[var] = {'chunksizes': chunks, 'zlib': True}
+            else:
+                encoding[var] = {'chunks': chunks}
+        if self.netcdf:
+            entry.to_netcdf(self.path, engine='netcdf4', encoding=encoding,
+                            unlimited_dims=['mid_date'])
+        else:
+            entry.to_zarr(self.path, mode='w-', encoding=encoding)
+
+    def _append(self, entry):
+        if not self.netcdf:
+            entry.to_zarr(self.path, append_dim='mid_date')
+            return
+        # NetCDF: write the next index of the unlimited mid_date dimension
+        with netCDF4.Dataset(self.path, 'a') as nc:
+            n = nc.dimensions['mid_date'].size
+            for name in ('mid_date', 'start_date', 'end_date'):
+                t = pd.Timestamp(entry[name].values[0]).to_pydatetime()
+                nc[name][n] = netCDF4.date2num(t, nc[name].units,
+                                               nc[name].calendar)
+            nc['pair_days'][n] = entry['pair_days'].values[0]
+            for var in self.variables:
+                nc[var][n] = entry[var].values[0]
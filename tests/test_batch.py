@@ -0,0 +1,21 @@
+import json
+import pytest
+
+pytest.importorskip('carst')
+pytest.importorskip('osgeo')
+pytest.importorskip('ipyleaflet')
+
+
+@pytest.mark.parametrize('store', [None, 'zarr'])
+def test_empty_pair_selection_writes_an_empty_manifest(tmp_path, store):
+    import eztrack
+    from geostacks import SpatialIndexLS8
+    scene_list = SpatialIndexLS8.build_scene_list(['c1/L8/009/011/LC08_L1TP_009011_20180612_20180615_01_T1/',
+                                                   'c1/L8/009/011/LC08_L1TP_009011_20180628_20180704_01_T1/'])
+    pairs = eztrack.generate_pairs(scene_list, max_baseline=10)    # the scenes are 16 days apart
+    assert len(pairs) == 0
+    batch = eztrack.BatchFeatureTrack(params=eztrack.FTParams(), output_folder=str(tmp_path), store=store,
+                                      cache=eztrack.PreprocessCache(str(tmp_path / 'cache')))
+    assert len(batch.run(scene_list, pairs)) == 0
+    with open(str(tmp_path / 'manifest.json')) as f:
+        assert json.load(f)['jobs'] == []
@@ -0,0 +1,115 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+from downloader import GranuleDownloader
+
+DATA = bytes(range(256)) * 40    # 10240 bytes
+ETAG = '"v1"'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves DATA at any path, with an ETag and (if honor_range) single byte ranges.
+    head_size: the Content-Length given to HEAD requests (default: the real size).
+    """
+    honor_range = True
+    head_size = None
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.requests.append(('HEAD', self.path, dict(self.headers)))
+        self.send_response(200)
+        self.send_header('Content-Length', str(self.head_size or len(DATA)))
+        self.send_header('ETag', ETAG)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path, dict(self.headers)))
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if self.honor_range and range_header and if_range in (None, ETAG):
+            start = int(range_header.split('=')[1].rstrip('-'))
+            body = DATA[start:]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(DATA) - 1, len(DATA)))
+        else:
+            body = DATA
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    handler = type('Handler', (RangeHandler,), {'requests': []})
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield handler, 'http://127.0.0.1:{}/granules/'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_indexed_file_is_skipped_without_a_request(server, tmp_path):
+    handler, base_url = server
+    url = base_url + 'a.nc'
+    downloader = GranuleDownloader(str(tmp_path), chunk_size=1000)
+    path = downloader.download_file(url)
+    assert read(path) == DATA
+    del handler.requests[:]
+    # the same downloader and a new one reading dest_dir/index.json
+    assert downloader.download([url]) == [path]
+    assert GranuleDownloader(str(tmp_path)).download([url]) == [path]
+    assert handler.requests == []
+
+
+def test_partial_file_is_resumed_with_a_range_request(server, tmp_path):
+    handler, base_url = server
+    part_path = str(tmp_path / 'b.nc.part')
+    with open(part_path, 'wb') as f:
+        f.write(DATA[:3000])
+    with open(part_path + '.etag', 'w') as f:
+        f.write(ETAG)
+    path = GranuleDownloader(str(tmp_path)).download_file(base_url + 'b.nc')
+    assert read(path) == DATA
+    get = [headers for method, _, headers in handler.requests if method == 'GET']
+    assert len(get) == 1
+    assert get[0]['Range'] == 'bytes=3000-'
+    assert get[0]['If-Range'] == ETAG
+    assert not os.path.exists(part_path) and not os.path.exists(part_path + '.etag')
+
+
+def test_whole_file_is_fetched_when_the_server_ignores_the_range(server, tmp_path):
+    handler, base_url = server
+    handler.honor_range = False
+    part_path = str(tmp_path / 'c.nc.part')
+    with open(part_path, 'wb') as f:
+        f.write(DATA[:3000])
+    with open(part_path + '.etag', 'w') as f:
+        f.write(ETAG)
+    path = GranuleDownloader(str(tmp_path)).download_file(base_url + 'c.nc')
+    assert read(path) == DATA    # overwritten, not appended to the partial file
+    assert [method for method, _, _ in handler.requests] == ['HEAD', 'GET']
+
+
+def test_size_mismatch_raises(server, tmp_path):
+    handler, base_url = server
+    handler.head_size = len(DATA) + 100
+    downloader = GranuleDownloader(str(tmp_path))
+    with pytest.raises(IOError, match='size mismatch'):
+        downloader.download_file(base_url + 'd.nc')
+    assert os.listdir(str(tmp_path)) == []
+    assert downloader.index == {}
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+pytest.importorskip('carst')
+pytest.importorskip('osgeo')
+rasterio = pytest.importorskip('rasterio')
+from rasterio.transform import Affine
+
+RES = 15.
+ULX, ULY = 400000., 7700000.
+OFFSET = 60      # image 2 starts this many pixels east and south of image 1
+SHIFT = 3        # features move this many pixels east between the images
+SIZE = 400
+
+
+def write_scene(fpath, data, ulx, uly):
+    with rasterio.open(fpath, 'w', driver='GTiff', width=data.shape[1], height=data.shape[0], count=1,
+                       dtype='uint16', crs='EPSG:32622', transform=Affine(RES, 0, ulx, 0, -RES, uly)) as dst:
+        dst.write(data, 1)
+
+
+@pytest.fixture
+def scene_pair(tmp_path):
+    rng = np.random.default_rng(0)
+    texture = gaussian_filter(rng.normal(size=(SIZE + OFFSET, SIZE + OFFSET)), 1.5)
+    texture = (1000 + 3000 * (texture - texture.min()) / np.ptp(texture)).astype('uint16')
+    file1 = str(tmp_path / 'scene1.tif')
+    file2 = str(tmp_path / 'scene2.tif')
+    write_scene(file1, texture[:SIZE, :SIZE], ULX, ULY)
+    write_scene(file2, texture[OFFSET:, OFFSET - SHIFT:SIZE + OFFSET - SHIFT], ULX + OFFSET * RES, ULY - OFFSET * RES)
+    return file1, file2
+
+
+def track(file1, file2, tmp_path, **kwargs):
+    import eztrack
+    params = eztrack.FTParams()
+    params.pxsettings.update(refwindow_x=32, refwindow_y=32, searchwindow_x=8, searchwindow_y=8,
+                             skip_across=16, skip_down=16, threads=1)
+    params.outputcontrol['output_folder'] = str(tmp_path)
+    return eztrack.carst_featuretrack(file1, '2020-01-01', file2, '2020-01-11', params=params, kernel='ncc',
+                                      **kwargs)
+
+
+def expected_transform():
+    # the grid is the overlap of the two scenes, the first chip center is
+    # searchwindow + refwindow // 2 pixels from its upper-left corner, and
+    # the velocity pixels are one chip spacing (skip) wide
+    return Affine(16 * RES, 0, ULX + (OFFSET + 8 + 16) * RES, 0, -16 * RES, ULY - (OFFSET + 8 + 16) * RES)
+
+
+@pytest.mark.parametrize('in_memory', [False, True])
+def test_output_is_on_the_overlap_grid(scene_pair, tmp_path, monkeypatch, in_memory):
+    monkeypatch.chdir(tmp_path)
+    result = track(*scene_pair, tmp_path, in_memory=in_memory)
+    if in_memory:
+        result[1].close()
+        fpath = str(tmp_path / '20200101-20200111_velo-raw.tif')    # band 1: magnitude
+    else:
+        fpath = str(tmp_path / '20200101-20200111_velo-raw_mag.tif')
+    with rasterio.open(fpath) as src:
+        assert src.transform.almost_equals(expected_transform())
+        v = src.read(1, masked=True)
+    assert np.ma.median(v) == pytest.approx(SHIFT * RES / 10, abs=0.1)
@@ -0,0 +1,59 @@
+import os
+import pytest
+
+from lruindex import LRUIndex
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    index = LRUIndex(str(tmp_path / 'index.sqlite'), 'entries', max_bytes=250)
+    assert index.put('a', 'A', 100) == []
+    assert index.put('b', 'B', 100) == []
+    assert index.put('c', 'C', 100) == [('a', 'A')]
+    index.get('b')    # b is now used after c
+    assert index.put('d', 'D', 100) == [('c', 'C')]
+    assert index.get('a') is None and index.get('c') is None
+    assert index.get('d')[0] == 'D'
+
+
+def test_protected_entries_are_kept(tmp_path):
+    index = LRUIndex(str(tmp_path / 'index.sqlite'), 'entries', max_bytes=150)
+    index.put('a', 'A', 100)
+    # without protect, a would make room for b
+    assert index.put('b', 'B', 100, protect=['a', 'b']) == []
+    assert index.get('a') is not None and index.get('b') is not None
+    assert sorted(index.put('c', 'C', 100)) == [('a', 'A'), ('b', 'B')]
+    assert index.clear() == [('c', 'C')]
+
+
+def test_catalog_cache_uses_the_index(tmp_path):
+    geostacks = pytest.importorskip('geostacks')
+    cache = geostacks.CatalogCache(str(tmp_path / 'catalog.sqlite'), max_bytes=None)
+    calls = []
+    key = cache.make_key('landsat-pds', {'prefix': 'c1/L8/009/011/'})
+    for _ in range(2):
+        assert cache.fetch(key, lambda: calls.append(1) or ['x', 'y']) == ['x', 'y']
+    assert len(calls) == 1
+    cache.clear()
+    assert cache.get(key) is None
+
+
+def test_prepare_pair_keeps_both_scenes(tmp_path, monkeypatch):
+    pytest.importorskip('carst')
+    prepcache = pytest.importorskip('prepcache')
+
+    def build(self, key, url, grid, gaussian_hp_sigma, protect=()):
+        entry_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(entry_dir)
+        fpath = os.path.join(entry_dir, os.path.basename(url))
+        with open(fpath, 'wb') as f:
+            f.write(b'\0' * 100)
+        self.put(key, fpath, protect=protect)
+        return fpath
+
+    monkeypatch.setattr(prepcache.PreprocessCache, '_build', build)
+    monkeypatch.setattr(prepcache, 'SingleRaster', lambda fpath, date=None: fpath)
+    cache = prepcache.PreprocessCache(str(tmp_path / 'cache'), max_bytes=150)
+    a, b = cache.prepare_pair(['s3://bucket/a_B8.TIF', 's3://bucket/b_B8.TIF'])
+    assert os.path.exists(a) and os.path.exists(b)
+    c = cache.prepare('s3://bucket/c_B8.TIF')
+    assert os.path.exists(c) and not os.path.exists(a) and not os.path.exists(b)
@@ -0,0 +1,46 @@
+import warnings
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter, shift
+
+from ncc import gaussian_highpass, ncc_offsets, ncc_offsets_tiled
+
+PXSETTINGS = {'refwindow_x': 32, 'refwindow_y': 32, 'searchwindow_x': 6, 'searchwindow_y': 6,
+              'skip_across': 16, 'skip_down': 16, 'oversampling': 64}
+
+
+def texture(shape=(160, 192), seed=0):
+    rng = np.random.default_rng(seed)
+    return 100.0 + 20.0 * gaussian_filter(rng.standard_normal(shape), 2.0)
+
+
+@pytest.mark.parametrize('dy, dx', [(0.3, -1.6), (-2.25, 0.75)])
+def test_subpixel_shift(dy, dx):
+    img1 = texture()
+    img2 = shift(img1, (dy, dx), order=3, mode='nearest')
+    field = ncc_offsets(img1, img2, PXSETTINGS)
+    assert len(field) > 0
+    assert np.median(field[:, 1]) == pytest.approx(dx, abs=0.1)
+    assert np.median(field[:, 3]) == pytest.approx(dy, abs=0.1)
+
+
+def test_identical_images_give_valid_covariances():
+    # a perfect match puts the correlation peak at (or rounding above) 1
+    img = texture()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        field = ncc_offsets(img, img, PXSETTINGS)
+    assert len(field) > 0
+    np.testing.assert_allclose(field[:, [1, 3]], 0.0, atol=0.05)
+    assert np.isfinite(field).all()
+    assert (field[:, 5] >= 0).all() and (field[:, 6] >= 0).all()
+
+
+def test_tiled_matches_untiled_with_highpass():
+    img1 = texture()
+    img2 = shift(img1, (1.4, -0.6), order=3, mode='nearest')
+    sigma = 3.0
+    expected = ncc_offsets(gaussian_highpass(img1, sigma), gaussian_highpass(img2, sigma), PXSETTINGS)
+    tiled = ncc_offsets_tiled(img1, img2, PXSETTINGS, workers=2, n_tiles=3, gaussian_hp_sigma=sigma)
+    assert len(expected) > 0
+    np.testing.assert_allclose(tiled, expected)
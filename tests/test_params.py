@@ -0,0 +1,47 @@
+import os
+import pytest
+
+pytest.importorskip('carst')
+pytest.importorskip('osgeo')
+pytest.importorskip('ipyleaflet')
+
+PARAM_INI = os.path.join(os.path.dirname(__file__), '..', 'notebooks', 'param.ini')
+
+
+def test_ini_values_take_the_types_of_the_defaults():
+    import eztrack
+    ini = eztrack.FTParams().ReadParam(PARAM_INI)
+    assert ini.pxsettings['refwindow_x'] == 64
+    assert ini.pxsettings['gaussian_hp'] is False
+    assert ini.pxsettings['gaussian_hp_sigma'] == 3.0
+    assert ini.rawoutput['if_generate_xyztext'] is False
+    assert ini.rawoutput['label_geotiff'] == 'velo-raw'
+    assert ini.noiseremoval == {'snr': 5, 'gaussian_lp_mask_sigma': 5, 'min_clump_size': 101,
+                                'outlier_sigma_threshold': 3}
+    assert ini.imagepair['image1'] is None
+
+
+class RecordingCache:
+
+    def __init__(self):
+        self.calls = []
+
+    def prepare(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+
+
+@pytest.mark.parametrize('kernel', ['ncc', 'ampcor'])
+def test_batch_with_the_default_ini(tmp_path, kernel):
+    import eztrack
+    cache = RecordingCache()
+    batch = eztrack.BatchFeatureTrack(inipath=PARAM_INI, kernel=kernel, output_folder=str(tmp_path), cache=cache)
+    ini = batch.new_params()
+    assert ini.pxsettings['threads'] == 1
+    assert ini.outputcontrol['output_folder'] == str(tmp_path)
+    ini.imagepair.update(image1_date='2018-06-12', image2_date='2018-06-28')
+    ini.VerifyParams()
+    assert ini.rawoutput['label_geotiff'] == os.path.join(str(tmp_path), '20180612-20180628_velo-raw')
+
+    assert batch.prepare_scenes(['a.TIF', 'b.TIF'], grid=None, ini=ini) == {'a.TIF': True, 'b.TIF': True}
+    # gaussian_hp = 0 in param.ini
+    assert [kwargs['gaussian_hp_sigma'] for url, kwargs in cache.calls] == [None, None]
@@ -0,0 +1,34 @@
+import types
+import numpy as np
+import xarray as xr
+
+import postproc
+
+
+def velocity_field(ny=60, nx=80, seed=0):
+    rng = np.random.default_rng(seed)
+    vx = 1. + rng.normal(0, 0.05, (ny, nx))
+    vy = rng.normal(0, 0.05, (ny, nx))
+    vx[20, 30] = 40.    # outlier
+    dims = ('y', 'x')
+    ds = xr.Dataset({'vx': (dims, vx), 'vy': (dims, vy), 'v': (dims, np.hypot(vx, vy)),
+                     'snr': (dims, rng.uniform(2, 30, (ny, nx))),
+                     'errx': (dims, np.ones((ny, nx))), 'erry': (dims, np.ones((ny, nx)))},
+                    coords={'x': 400000 + 960. * np.arange(nx), 'y': 7700000 - 960. * np.arange(ny)})
+    ds.attrs['crs'] = 'EPSG:32622'
+    return ds
+
+
+def test_string_valued_ini_sections():
+    # as read by carst's ConfParams from param.ini
+    ini = types.SimpleNamespace(
+        velocorrection={'bedrock': '', 'refvelo_outlier_sigma': '3.0', 'label_geotiff': 'velo-corrected'},
+        noiseremoval={'snr': '5', 'gaussian_lp_mask_sigma': '5', 'min_clump_size': '101',
+                      'outlier_sigma_threshold': '3'})
+    ds = velocity_field()
+    out = postproc.postprocess(ds, ini)
+    expected = postproc.postprocess(ds, snr=5, gaussian_lp_mask_sigma=5, min_clump_size=101,
+                                    outlier_sigma_threshold=3)
+    xr.testing.assert_identical(out, expected)
+    assert np.isnan(out['v'].values[20, 30])
+    assert np.isnan(out['v'].values[ds['snr'].values <= 5]).all()
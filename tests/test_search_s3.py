@@ -0,0 +1,66 @@
+import datetime
+import pandas as pd
+import pytest
+
+moto = pytest.importorskip('moto')
+import boto3
+
+from geostacks import CatalogCache, SpatialIndexLS8
+
+
+def scene_prefixes(path, row, n):
+    start = datetime.date(2013, 4, 1)
+    prefixes = []
+    for i in range(n):
+        date = (start + datetime.timedelta(days=i)).strftime('%Y%m%d')
+        name = 'LC08_L1TP_{:03d}{:03d}_{}_{}_01_T1'.format(path, row, date, date)
+        prefixes.append('c1/L8/{:03d}/{:03d}/{}/'.format(path, row, name))
+    return prefixes
+
+
+@pytest.fixture
+def landsat_pds(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    # the client is shared by the class; make a fresh one for the mock and drop it afterwards
+    monkeypatch.setattr(SpatialIndexLS8, '_s3_client', None)
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-west-2')
+        s3.create_bucket(Bucket='landsat-pds', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+        yield s3
+
+
+def put_scenes(s3, prefixes):
+    for prefix in prefixes:
+        s3.put_object(Bucket='landsat-pds', Key=prefix + 'index.html', Body=b'')
+
+
+def make_index(pathrows, cache=None):
+    index = SpatialIndexLS8(cache=cache)
+    index.footprint = pd.DataFrame({'path': [p for p, r in pathrows], 'row': [r for p, r in pathrows]})
+    return index
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_search_s3_follows_continuation_tokens(landsat_pds, tmp_path, use_cache):
+    expected = scene_prefixes(9, 11, 1200)    # more than one page of 1000
+    put_scenes(landsat_pds, expected)
+    cache = CatalogCache(str(tmp_path / 'catalog.sqlite')) if use_cache else None
+    s3_prefix, scene_list = make_index([(9, 11)], cache=cache).search_s3(0)
+    assert s3_prefix == 'c1/L8/009/011/LC08_L1TP_'
+    assert len(scene_list) == 1200
+    assert sorted(scene_list['prefix']) == sorted(expected)
+    assert (scene_list['tier'] == 'T1').all()
+    assert scene_list['time'].min() == pd.Timestamp('2013-04-01')
+
+
+def test_search_s3_many(landsat_pds):
+    pathrows = [(9, 11), (10, 11), (9, 12)]
+    for i, (path, row) in enumerate(pathrows):
+        put_scenes(landsat_pds, scene_prefixes(path, row, 5 + i))
+    results = make_index(pathrows).search_s3_many(range(len(pathrows)), max_workers=3)
+    assert sorted(results) == [0, 1, 2]
+    for i, (path, row) in enumerate(pathrows):
+        s3_prefix, scene_list = results[i]
+        assert s3_prefix == 'c1/L8/{:03d}/{:03d}/LC08_L1TP_'.format(path, row)
+        assert sorted(scene_list['prefix']) == scene_prefixes(path, row, 5 + i)
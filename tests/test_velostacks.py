@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+pytest.importorskip('h5netcdf')
+from velostacks import VelocityStack
+
+NAMES = ['LC08_L1TP_009011_20180730_20180814_01_T1_X_LC08_L1TP_009011_20180612_20180615_01_T1_G0240V01_P086.nc',
+         'LC08_L1TP_009011_20180815_20180828_01_T1_X_LC08_L1TP_009011_20180730_20180814_01_T1_G0240V01_P090.nc']
+
+
+def write_granule(path, value):
+    x = 100000.0 + 240.0 * np.arange(6)
+    y = -2000000.0 - 240.0 * np.arange(5)
+    data = np.full((5, 6), value, dtype='float32')
+    ds = xr.Dataset({name: (('y', 'x'), data) for name in ('v', 'vx', 'vy')}, coords={'x': x, 'y': y})
+    ds['mapping'] = xr.DataArray(0, attrs={'spatial_epsg': 3413})
+    ds.to_netcdf(path, engine='h5netcdf')
+
+
+@pytest.fixture
+def granules(tmp_path):
+    paths = [str(tmp_path / name) for name in NAMES]
+    for i, path in enumerate(paths):
+        write_granule(path, 100.0 * (i + 1))
+    return paths
+
+
+def test_with_block_closes_the_granules(granules):
+    with VelocityStack().build(granules, max_workers=2) as stack:
+        assert len(stack.sources) == 2
+        cube = stack.cube
+        np.testing.assert_allclose(cube.v.mean(dim=('x', 'y')).values, [100.0, 200.0])
+    assert stack.sources == []
+    with pytest.raises(RuntimeError, match='closed'):
+        cube.v.values    # the files behind the lazy cube are closed
+
+
+def test_close_is_idempotent(granules):
+    stack = VelocityStack().build(granules)
+    stack.cube = stack.cube.load()
+    stack.close()
+    stack.close()
+    assert stack.sources == []
+    np.testing.assert_allclose(stack.cube.v.mean(dim=('x', 'y')).values, [100.0, 200.0])